@@ -121,6 +121,11 @@ ISSUE_CONFIG_KEY = 'gerritissue'
 PATCHSET_CONFIG_KEY = 'gerritpatchset'
 CODEREVIEW_SERVER_CONFIG_KEY = 'gerritserver'
 
+# The Gerrit change details `git cl upload` fetches up front, to warm the
+# change detail cache for the rest of the upload.
+_CHANGE_DETAIL_OPTIONS = frozenset(
+    ['DETAILED_ACCOUNTS', 'CURRENT_REVISION', 'CURRENT_COMMIT', 'LABELS'])
+
 # Shortcut since it quickly becomes repetitive.
 Fore = colorama.Fore
 
@@ -652,17 +657,29 @@ def _GetYapfIgnorePatterns(top_dir):
     A set of all fnmatch patterns to be ignored.
   """
   yapfignore_file = os.path.join(top_dir, '.yapfignore')
-  ignore_patterns = set()
   if not os.path.exists(yapfignore_file):
-    return ignore_patterns
+    return set()
 
   with open(yapfignore_file) as f:
-    for line in f.readlines():
-      stripped_line = line.strip()
-      # Comments and blank lines should be ignored.
-      if stripped_line.startswith('#') or stripped_line == '':
-        continue
-      ignore_patterns.add(stripped_line)
+    return _ParseYapfIgnorePatterns(f)
+
+
+def _ParseYapfIgnorePatterns(lines):
+  """Returns all patterns in the given lines of a .yapfignore file.
+
+  Args:
+    lines: An iterable of strings containing the lines of the file.
+
+  Returns:
+    A set of all fnmatch patterns to be ignored.
+  """
+  ignore_patterns = set()
+  for line in lines:
+    stripped_line = line.strip()
+    # Comments and blank lines should be ignored.
+    if stripped_line.startswith('#') or stripped_line == '':
+      continue
+    ignore_patterns.add(stripped_line)
   return ignore_patterns
 
 
@@ -677,9 +694,14 @@ def _FilterYapfIgnoredFiles(filepaths, patterns):
     A list of strings containing all the elements of |filepaths| that did not
     match any of the patterns in |patterns|.
   """
+  if not patterns:
+    return list(filepaths)
+  # Match against all the patterns at once, with a single regex. Like
+  # fnmatch.fnmatch, normalize the case of both the patterns and the paths.
+  ignored = re.compile('|'.join(
+      fnmatch.translate(os.path.normcase(p)) for p in patterns))
   # Not inlined so that tests can use the same implementation.
-  return [f for f in filepaths
-          if not any(fnmatch.fnmatch(f, p) for p in patterns)]
+  return [f for f in filepaths if not ignored.match(os.path.normcase(f))]
 
 
 def print_stats(args):
@@ -1820,14 +1842,14 @@ class Changelist(object):
     options = options or []
     assert self.GetIssue(), 'issue is required to query Gerrit'
 
-    # Optimization to avoid multiple RPCs:
-    if 'CURRENT_REVISION' in options or 'ALL_REVISIONS' in options:
-      options.append('CURRENT_COMMIT')
-
     # Normalize issue and options for consistent keys in cache.
     cache_key = str(self.GetIssue())
     options_set = frozenset(o.upper() for o in options)
 
+    # Optimization to avoid multiple RPCs:
+    if 'CURRENT_REVISION' in options or 'ALL_REVISIONS' in options:
+      options_set = options_set.union(['CURRENT_COMMIT'])
+
     for cached_options_set, data in self._detail_cache.get(cache_key, []):
       # Assumption: data fetched before with extra options is suitable
       # for return for a smaller set of options.
@@ -4114,8 +4136,7 @@ def CMDupload(parser, args):
   # Warm change details cache now to avoid RPCs later, reducing latency for
   # developers.
   if cl.GetIssue():
-    cl._GetChangeDetail(
-        ['DETAILED_ACCOUNTS', 'CURRENT_REVISION', 'CURRENT_COMMIT', 'LABELS'])
+    cl._GetChangeDetail(_CHANGE_DETAIL_OPTIONS)
 
   if options.retry_failed and not cl.GetIssue():
     print('No previous patchsets, so --retry-failed has no effect.')
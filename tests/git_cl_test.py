@@ -9,13 +9,13 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import collections
 import datetime
+import itertools
 import json
 import logging
-import multiprocessing
 import optparse
 import os
-import pprint
 import shutil
 import sys
 import tempfile
@@ -28,7 +28,11 @@ else:
   from io import StringIO
   from unittest import mock
 
-sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+DEPOT_TOOLS_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The module may be imported more than once by the same process, e.g. by a test
+# runner, so don't keep growing sys.path.
+if DEPOT_TOOLS_ROOT not in sys.path:
+  sys.path.insert(0, DEPOT_TOOLS_ROOT)
 
 import metrics
 # We have to disable monitoring before importing git_cl.
@@ -41,7 +45,6 @@ import gerrit_util
 import git_cl
 import git_common
 import git_footers
-import git_new_branch
 import scm
 import subprocess2
 
@@ -53,11 +56,176 @@ def callError(code=1, cmd='', cwd='', stdout=b'', stderr=b''):
 
 CERR1 = callError(1)
 
+# Arguments of calls which show up in most of the upload tests.
+_GIT_REV_PARSE_HEAD_TREE = (['git', 'rev-parse', 'HEAD:'],)
+_GIT_SHOW_SUBJECT = (['git', 'show', '-s', '--format=%s', 'HEAD'],)
+_GIT_CONFIG_LIST = (['git', 'config', '-l'],)
+_TRACE_NAME = os.path.join('TRACES_DIR', '20170316T200041.000000')
+_TRACE_PACKET = os.path.join('TEMP_DIR', 'trace-packet')
+# The README written for the trace of an upload, with the parts that are the
+# same for every upload test already filled in.
+_TRACE_README = (
+    '2017-03-16T20:00:41.000000\n'
+    '%(gerrit_host)s\n'
+    '%(change_id)s\n'
+    '%(title)s\n'
+    '%(description)s\n'
+    '1000\n'
+    '0\n' + _TRACE_NAME)
+_GIT_CONFIG_PATH = os.path.join('TEMP_DIR', 'git-config')
+_GITCOOKIES_PATH = os.path.join('~', '.gitcookies')
+_DEFAULT_GITCOOKIES = os.path.expanduser(_GITCOOKIES_PATH)
+_NETRC_PATH = os.path.join('~', NETRC_FILENAME)
+_GITCOOKIES_OUT = os.path.join('TEMP_DIR', 'gitcookies')
+_COMMIT_MSG_HOOK = os.path.join('.git', 'hooks', 'commit-msg')
+_MISSING_CREDS_MESSAGE = (
+    'Credentials for the following hosts are required:\n'
+    '  chromium-review.googlesource.com\n'
+    'These are read from %s (or legacy %s)\n'
+    'You can (re)generate your credentials by visiting '
+    'https://chromium-review.googlesource.com/new-password\n' % (
+        _GITCOOKIES_PATH, _NETRC_PATH))
+
+# The calls an upload makes to collect its traces, which are the same for
+# every upload test.
+_TRACE_CALLS = (
+    # Read traces and shorten git hashes.
+    (
+        (['os.path.isfile', _TRACE_PACKET], ),
+        True,
+    ),
+    (
+        (['FileRead', _TRACE_PACKET], ),
+        ('git-hash: 0123456789012345678901234567890123456789\n'
+         'git-hash: abcdeabcdeabcdeabcdeabcdeabcdeabcdeabcde\n'),
+    ),
+    (
+        ([
+            'FileWrite', _TRACE_PACKET, 'git-hash: 012345\n'
+            'git-hash: abcdea\n'
+        ], ),
+        None,
+    ),
+    # Make zip file for the git traces.
+    (
+        (['make_archive', _TRACE_NAME + '-traces', 'zip', 'TEMP_DIR'], ),
+        None,
+    ),
+    # Collect git config and gitcookies.
+    (
+        _GIT_CONFIG_LIST,
+        'git-config-output',
+    ),
+    (
+        (['FileWrite', _GIT_CONFIG_PATH, 'git-config-output'], ),
+        None,
+    ),
+)
+
+# The calls collecting the gitcookies when the user has them.
+_GITCOOKIES_TRACE_CALLS = (
+    (
+        (['FileRead', _GITCOOKIES_PATH], ),
+        'gitcookies 1/SECRET',
+    ),
+    (
+        (['FileWrite', _GITCOOKIES_OUT, 'gitcookies REDACTED'], ),
+        None,
+    ),
+)
+
+
+@git_common.memoize_one(threadsafe=False)
+def _utf8(s):
+  """Encodes the output of a mocked git command, which is often the same."""
+  return s.encode('utf-8')
+
+
+@git_common.memoize_one(threadsafe=False)
+def _has_change_id(description):
+  """Whether the description has a Change-Id footer.
+
+  Many upload tests use the same descriptions, so parse each of them once.
+  """
+  return bool(git_footers.get_footer_change_id(description))
+
+
+def _get_change_detail(description, status, owner, change_id):
+  """Returns the change detail GetChangeDetail serves in upload tests.
+
+  A new one is built on every call. Tests may modify the nested dicts, so
+  sharing them between tests would make the tests depend on their order.
+  """
+  return {
+    'owner': {'email': owner},
+    'change_id': change_id,
+    'current_revision': 'sha1_of_current_revision',
+    'revisions': {'sha1_of_current_revision': {
+      'commit': {'message': description},
+    }},
+    'status': status,
+  }
+
+
+def _get_patch_change_detail(git_short_host):
+  """Returns the change detail GetChangeDetail serves in patch tests.
+
+  Like _get_change_detail, a new one is built on every call.
+  """
+  url = 'https://%s.googlesource.com/my/repo' % git_short_host
+  return {
+    'current_revision': '7777777777',
+    'revisions': {
+      '1111111111': {
+        '_number': 1,
+        'fetch': {'http': {
+          'url': url,
+          'ref': 'refs/changes/56/123456/1',
+        }},
+      },
+      '7777777777': {
+        '_number': 7,
+        'fetch': {'http': {
+          'url': url,
+          'ref': 'refs/changes/56/123456/7',
+        }},
+      },
+    },
+  }
+
+
+# The output of `git for-each-ref` for test_upload_branch_deps, describing a
+# local branch dependency tree that looks like this:
+# test1 -> test2 -> test3   -> test4 -> test5
+#                -> test3.1
+# test6 -> test0
+_BRANCH_DEPS = '\n'.join([
+    'test2 test1',    # test1 -> test2
+    'test3 test2',    # test2 -> test3
+    'test3.1 test2',  # test2 -> test3.1
+    'test4 test3',    # test3 -> test4
+    'test5 test4',    # test4 -> test5
+    'test6 test0',    # test0 -> test6
+    'test7',          # test7
+])
+
+
+class _NullIO(object):
+  """A file-like object which discards everything written to it."""
+  def write(self, s):
+    return len(s)
+
+  def flush(self):
+    pass
+
 
 class TemporaryFileMock(object):
   def __init__(self):
     self.suffix = 0
 
+  def reset(self):
+    self.suffix = 0
+
   @contextlib.contextmanager
   def __call__(self):
     self.suffix += 1
@@ -157,11 +325,11 @@ def CookiesAuthenticatorMockFactory(hosts_with_creds=None, same_auth=False):
       pass
     @classmethod
     def get_gitcookies_path(cls):
-      return os.path.join('~', '.gitcookies')
+      return _GITCOOKIES_PATH
 
     @classmethod
     def get_netrc_path(cls):
-      return os.path.join('~', NETRC_FILENAME)
+      return _NETRC_PATH
 
     def _get_auth_for_host(self, host):
       if same_auth:
@@ -170,6 +338,10 @@ def CookiesAuthenticatorMockFactory(hosts_with_creds=None, same_auth=False):
   return CookiesAuthenticatorMock
 
 
+# The mocks don't hold any state, so the one without credentials can be shared.
+NoCredsCookiesAuthenticatorMock = CookiesAuthenticatorMockFactory()
+
+
 class MockChangelistWithBranchAndIssue():
   def __init__(self, branch, issue):
     self.branch = branch
@@ -180,15 +352,86 @@ class MockChangelistWithBranchAndIssue():
     return self.issue
 
 
+class _IMapIteratorMock(object):
+  def __init__(self, results):
+    self._results = iter(results)
+
+  def __iter__(self):
+    return self
+
+  def next(self, timeout=None):
+    del timeout
+    return next(self._results)
+
+  __next__ = next
+
+
+class ThreadPoolMock(object):
+  """Runs the work given to a ThreadPool synchronously, without threads."""
+  def __init__(self, *_args, **_kwargs):
+    pass
+
+  def map(self, func, iterable):
+    return [func(i) for i in iterable]
+
+  def imap_unordered(self, func, iterable):
+    return _IMapIteratorMock(func(i) for i in iterable)
+
+  def close(self):
+    pass
+
+
 class SystemExitMock(Exception):
   pass
 
 
+def _enter_patchers(patchers):
+  """Installs patchers for a whole test class.
+
+  Uses the context manager protocol rather than start(), so that the
+  mock.patch.stopall() cleanup of each test leaves these patches alone. If one
+  of them fails, the ones already installed are removed again.
+
+  Returns:
+    The mocks the patchers created, with their configuration, to be passed to
+    _reset_mocks before each test.
+  """
+  entered = []
+  class_mocks = []
+  try:
+    for patcher in patchers:
+      new = patcher.__enter__()
+      entered.append(patcher)
+      if isinstance(new, mock.NonCallableMock):
+        class_mocks.append((new, patcher.kwargs))
+  except Exception:
+    _exit_patchers(entered)
+    raise
+  return class_mocks
+
+
+def _exit_patchers(patchers):
+  for patcher in reversed(patchers):
+    patcher.__exit__(None, None, None)
+
+
+def _reset_mocks(class_mocks):
+  """Resets the mocks returned by _enter_patchers to their initial state.
+
+  This drops the calls the previous test made, and any return value or side
+  effect it set, so that tests don't depend on the order they run in.
+  """
+  for class_mock, kwargs in class_mocks:
+    class_mock.reset_mock(return_value=True, side_effect=True)
+    class_mock.configure_mock(**kwargs)
+
+
 class TestGitClBasic(unittest.TestCase):
   def setUp(self):
     mock.patch('sys.exit', side_effect=SystemExitMock).start()
     mock.patch('sys.stdout', StringIO()).start()
     mock.patch('sys.stderr', StringIO()).start()
+    git_cl.settings = None
     self.addCleanup(mock.patch.stopall)
 
   def test_die_with_error(self):
@@ -214,6 +457,7 @@ class TestGitClBasic(unittest.TestCase):
 
   @mock.patch('git_cl.Changelist.EnsureAuthenticated')
   @mock.patch('git_cl.Changelist.GetStatus', lambda cl: cl.status)
+  @mock.patch('multiprocessing.pool.ThreadPool', ThreadPoolMock)
   def test_get_cl_statuses(self, *_mocks):
     statuses = [
         'closed', 'commit', 'dry-run', 'lgtm', 'reply', 'unsent', 'waiting']
@@ -232,6 +476,8 @@ class TestGitClBasic(unittest.TestCase):
   @mock.patch('git_cl.Changelist.EnsureAuthenticated')
   @mock.patch('multiprocessing.pool.ThreadPool')
   def test_get_cl_statuses_timeout(self, *_mocks):
+    # This is the only test which needs the module itself.
+    import multiprocessing
     changes = [git_cl.Changelist() for _ in range(2)]
     pool = multiprocessing.pool.ThreadPool()
     it = pool.imap_unordered.return_value.__iter__ = mock.Mock()
@@ -303,6 +549,7 @@ class TestGitClBasic(unittest.TestCase):
                      ['v8:456', 'chromium:123', 'v8:123'])
 
   @mock.patch('gerrit_util.GetAccountDetails')
+  @mock.patch('gerrit_util.ThreadPool', ThreadPoolMock)
   def test_valid_accounts(self, mockGetAccountDetails):
     mock_per_account = {
       'u1': None,  # 404, doesn't exist.
@@ -385,6 +632,32 @@ class TestParseIssueURL(unittest.TestCase):
 
 
 class GitCookiesCheckerTest(unittest.TestCase):
+  # The (subhost, identity) pairs test_analysis and test_report run against.
+  _HOSTS_CREDS = (
+    ('.googlesource.com',      'git-example.chromium.org'),
+
+    ('chromium',               'git-example.google.com'),
+    ('chromium-review',        'git-example.google.com'),
+    ('chrome-internal',        'git-example.chromium.org'),
+    ('chrome-internal-review', 'git-example.chromium.org'),
+    ('conflict',               'git-example.google.com'),
+    ('conflict-review',        'git-example.chromium.org'),
+    ('dup',                    'git-example.google.com'),
+    ('dup',                    'git-example.google.com'),
+    ('dup-review',             'git-example.google.com'),
+    ('partial',                'git-example.google.com'),
+    ('gpartial-review',        'git-example.google.com'),
+  )
+
+  @classmethod
+  def setUpClass(cls):
+    super(GitCookiesCheckerTest, cls).setUpClass()
+    with open(os.path.join(os.path.dirname(__file__),
+                           'git_cl_creds_check_report.txt')) as f:
+      cls._expected_report = f.read() % {
+          'sep': os.sep,
+      }
+
   def setUp(self):
     super(GitCookiesCheckerTest, self).setUp()
     self.c = git_cl._GitCookiesChecker()
@@ -423,21 +696,7 @@ class GitCookiesCheckerTest(unittest.TestCase):
     self.assertEqual(set(), self.c.get_hosts_with_wrong_identities())
 
   def test_analysis(self):
-    self.mock_hosts_creds([
-      ('.googlesource.com',      'git-example.chromium.org'),
-
-      ('chromium',               'git-example.google.com'),
-      ('chromium-review',        'git-example.google.com'),
-      ('chrome-internal',        'git-example.chromium.org'),
-      ('chrome-internal-review', 'git-example.chromium.org'),
-      ('conflict',               'git-example.google.com'),
-      ('conflict-review',        'git-example.chromium.org'),
-      ('dup',                    'git-example.google.com'),
-      ('dup',                    'git-example.google.com'),
-      ('dup-review',             'git-example.google.com'),
-      ('partial',                'git-example.google.com'),
-      ('gpartial-review',        'git-example.google.com'),
-    ])
+    self.mock_hosts_creds(self._HOSTS_CREDS)
     self.assertTrue(self.c.has_generic_host())
     self.assertEqual(set(['conflict.googlesource.com']),
                      self.c.get_conflicting_hosts())
@@ -457,29 +716,72 @@ class GitCookiesCheckerTest(unittest.TestCase):
 
   @mock.patch(
       'git_cl.gerrit_util.CookiesAuthenticator.get_gitcookies_path',
-      return_value=os.path.join('~', '.gitcookies'))
+      return_value=_GITCOOKIES_PATH)
   def test_report(self, *_mocks):
     self.test_analysis()
     self.assertTrue(self.c.find_and_report_problems())
-    with open(os.path.join(os.path.dirname(__file__),
-                           'git_cl_creds_check_report.txt')) as f:
-      expected = f.read() % {
-          'sep': os.sep,
-      }
 
     def by_line(text):
       return [l.rstrip() for l in text.rstrip().splitlines()]
     self.maxDiff = 10000  # pylint: disable=attribute-defined-outside-init
-    self.assertEqual(by_line(sys.stdout.getvalue().strip()), by_line(expected))
+    self.assertEqual(by_line(sys.stdout.getvalue().strip()),
+                     by_line(self._expected_report))
 
 
 class TestGitCl(unittest.TestCase):
+  # Patches that don't depend on the state of any test. They are installed once
+  # for the whole class, and setUp resets their mocks before each test.
+  _CLASS_PATCHERS = (
+      mock.patch('git_common.is_dirty_git_tree', lambda x: False),
+      mock.patch('git_cl.FindCodereviewSettingsFile', return_value=''),
+      mock.patch('git_cl.watchlists.Watchlists', WatchlistsMock),
+      mock.patch('git_cl.auth.Authenticator', AuthenticatorMock),
+      mock.patch(
+          'git_cl.gerrit_util.LuciContextAuthenticator.is_luci',
+          return_value=False),
+      mock.patch(
+          'git_cl.gerrit_util.GceAuthenticator.is_gce', return_value=False),
+      mock.patch('git_cl.Settings.GetRoot', return_value=''),
+      mock.patch('scm.GIT.ResolveCommit', return_value='hash'),
+      mock.patch('scm.GIT.IsValidRevision', return_value=True),
+      mock.patch(
+          'scm.GIT.FetchUpstreamTuple',
+          return_value=('origin', 'refs/heads/master')),
+      mock.patch('scm.GIT.CaptureStatus', return_value=[('M', 'foo.txt')]),
+  )
+
+  # Patches whose mocks record calls or get configured by tests. The patchers
+  # are built once for the whole class, but started for each test.
+  _STATIC_PATCHERS = (
+      mock.patch(
+          'git_cl.Changelist.RunHook',
+          return_value={'more_cc': ['test-more-cc@chromium.org']}),
+      mock.patch('gerrit_util.GetChangeDetail'),
+      mock.patch('sys.exit', side_effect=SystemExitMock),
+  )
+
+  @classmethod
+  def setUpClass(cls):
+    super(TestGitCl, cls).setUpClass()
+    cls._class_mocks = _enter_patchers(cls._CLASS_PATCHERS)
+
+  @classmethod
+  def tearDownClass(cls):
+    _exit_patchers(cls._CLASS_PATCHERS)
+    super(TestGitCl, cls).tearDownClass()
+
   def setUp(self):
     super(TestGitCl, self).setUp()
     self.calls = []
-    self._calls_done = []
+    self._calls_done = 0
+    # The last few calls made, to give some context when a call doesn't match.
+    self._recent_calls = collections.deque(maxlen=5)
     self.failed = False
-    mock.patch('sys.stdout', StringIO()).start()
+    _reset_mocks(self._class_mocks)
+    for patcher in self._STATIC_PATCHERS:
+      patcher.start()
+    # Tests that check the output patch sys.stdout with a StringIO themselves.
+    mock.patch('sys.stdout', _NullIO()).start()
     mock.patch(
         'git_cl.time_time',
         lambda: self._mocked_call('time.time')).start()
@@ -495,23 +797,15 @@ class TestGitCl(unittest.TestCase):
     mock.patch(
         'git_cl.gclient_utils.CheckCallAndFilter',
         self._mocked_call).start()
-    mock.patch('git_common.is_dirty_git_tree', lambda x: False).start()
     mock.patch(
         'git_common.get_or_create_merge_base',
         lambda *a: self._mocked_call('get_or_create_merge_base', *a)).start()
-    mock.patch('git_cl.FindCodereviewSettingsFile', return_value='').start()
     mock.patch(
         'git_cl.SaveDescriptionBackup',
         lambda _: self._mocked_call('SaveDescriptionBackup')).start()
     mock.patch(
         'git_cl.write_json',
         lambda *a: self._mocked_call('write_json', *a)).start()
-    mock.patch(
-        'git_cl.Changelist.RunHook',
-        return_value={'more_cc': ['test-more-cc@chromium.org']}).start()
-    mock.patch('git_cl.watchlists.Watchlists', WatchlistsMock).start()
-    mock.patch('git_cl.auth.Authenticator', AuthenticatorMock).start()
-    mock.patch('gerrit_util.GetChangeDetail').start()
     mock.patch(
         'git_cl.gerrit_util.GetChangeComments',
         lambda *a: self._mocked_call('GetChangeComments', *a)).start()
@@ -526,40 +820,48 @@ class TestGitCl(unittest.TestCase):
         lambda h, i, msg=None, labels=None, notify=None, ready=None: (
             self._mocked_call(
                 'SetReview', h, i, msg, labels, notify, ready))).start()
-    mock.patch(
-        'git_cl.gerrit_util.LuciContextAuthenticator.is_luci',
-        return_value=False).start()
-    mock.patch(
-        'git_cl.gerrit_util.GceAuthenticator.is_gce',
-        return_value=False).start()
     mock.patch(
         'git_cl.gerrit_util.ValidAccounts',
         lambda *a: self._mocked_call('ValidAccounts', *a)).start()
-    mock.patch('sys.exit', side_effect=SystemExitMock).start()
-    mock.patch('git_cl.Settings.GetRoot', return_value='').start()
     self.mockGit = GitMocks()
     mock.patch('scm.GIT.GetBranchRef', self.mockGit.GetBranchRef).start()
     mock.patch('scm.GIT.GetConfig', self.mockGit.GetConfig).start()
-    mock.patch('scm.GIT.ResolveCommit', return_value='hash').start()
-    mock.patch('scm.GIT.IsValidRevision', return_value=True).start()
     mock.patch('scm.GIT.SetConfig', self.mockGit.SetConfig).start()
     mock.patch(
         'git_new_branch.create_new_branch', self.mockGit.NewBranch).start()
-    mock.patch(
-        'scm.GIT.FetchUpstreamTuple',
-        return_value=('origin', 'refs/heads/master')).start()
-    mock.patch(
-        'scm.GIT.CaptureStatus', return_value=[('M', 'foo.txt')]).start()
     # It's important to reset settings to not have inter-tests interference.
     git_cl.settings = None
+    ChangelistMock.desc = ''
     self.addCleanup(mock.patch.stopall)
 
+  @property
+  def calls(self):
+    return self._calls
+
+  @calls.setter
+  def calls(self, calls):
+    # Expected calls are consumed from the front, so keep them in a deque.
+    # Tests are free to assign or extend it with plain lists.
+    if not isinstance(calls, collections.deque):
+      calls = collections.deque(calls)
+    self._calls = calls
+
+  def _swap(self, obj, name, value):
+    """Sets obj.name to value until the end of the test.
+
+    A cheaper replacement for mock.patch(...).start() for tests which only need
+    to swap an attribute defined directly on obj.
+    """
+    self.addCleanup(setattr, obj, name, vars(obj)[name])
+    setattr(obj, name, value)
+
   def tearDown(self):
     try:
       if not self.failed:
-        self.assertEqual([], self.calls)
+        self.assertFalse(self.calls)
     except AssertionError:
-      calls = ''.join('  %s\n' % str(call) for call in self.calls[:5])
+      calls = ''.join(
+          '  %s\n' % str(call) for call in itertools.islice(self.calls, 5))
       if len(self.calls) > 5:
         calls += ' ...\n'
       self.fail(
@@ -570,50 +872,51 @@ class TestGitCl(unittest.TestCase):
       super(TestGitCl, self).tearDown()
 
   def _mocked_call(self, *args, **_kwargs):
-    self.assertTrue(
-        self.calls,
-        '@%d  Expected: <Missing>   Actual: %r' % (len(self._calls_done), args))
-    top = self.calls.pop(0)
+    if not self.calls:
+      self.fail(
+          '@%d  Expected: <Missing>   Actual: %r' % (self._calls_done, args))
+    top = self.calls.popleft()
     expected_args, result = top
 
+    if expected_args == args:
+      self._calls_done += 1
+      self._recent_calls.append(top)
+      if isinstance(result, Exception):
+        raise result
+      # stdout from git commands is supposed to be a bytestream. Convert it
+      # here instead of converting all test output in this file to bytes.
+      if args[0][0] == 'git' and not isinstance(result, bytes):
+        result = _utf8(result)
+      return result
+
     # Also logs otherwise it could get caught in a try/finally and be hard to
     # diagnose.
-    if expected_args != args:
-      N = 5
-      prior_calls = '\n  '.join(
-          '@%d: %r' % (len(self._calls_done) - N + i, c[0])
-          for i, c in enumerate(self._calls_done[-N:]))
-      following_calls = '\n  '.join(
-          '@%d: %r' % (len(self._calls_done) + i + 1, c[0])
-          for i, c in enumerate(self.calls[:N]))
-      extended_msg = (
-          'A few prior calls:\n  %s\n\n'
-          'This (expected):\n  @%d: %r\n'
-          'This (actual):\n  @%d: %r\n\n'
-          'A few following expected calls:\n  %s' %
-          (prior_calls, len(self._calls_done), expected_args,
-           len(self._calls_done), args, following_calls))
-
-      self.failed = True
-      self.fail('@%d\n'
-                '  Expected: %r\n'
-                '  Actual:   %r\n'
-                '\n'
-                '%s' % (
-          len(self._calls_done), expected_args, args, extended_msg))
-
-    self._calls_done.append(top)
-    if isinstance(result, Exception):
-      raise result
-    # stdout from git commands is supposed to be a bytestream. Convert it here
-    # instead of converting all test output in this file to bytes.
-    if args[0][0] == 'git' and not isinstance(result, bytes):
-      result = result.encode('utf-8')
-    return result
-
-  @mock.patch('sys.stdin', StringIO('blah\nye\n'))
-  @mock.patch('sys.stdout', StringIO())
+    N = self._recent_calls.maxlen
+    prior_calls = '\n  '.join(
+        '@%d: %r' % (self._calls_done - len(self._recent_calls) + i, c[0])
+        for i, c in enumerate(self._recent_calls))
+    following_calls = '\n  '.join(
+        '@%d: %r' % (self._calls_done + i + 1, c[0])
+        for i, c in enumerate(itertools.islice(self.calls, N)))
+    extended_msg = (
+        'A few prior calls:\n  %s\n\n'
+        'This (expected):\n  @%d: %r\n'
+        'This (actual):\n  @%d: %r\n\n'
+        'A few following expected calls:\n  %s' %
+        (prior_calls, self._calls_done, expected_args,
+         self._calls_done, args, following_calls))
+
+    self.failed = True
+    self.fail('@%d\n'
+              '  Expected: %r\n'
+              '  Actual:   %r\n'
+              '\n'
+              '%s' % (
+        self._calls_done, expected_args, args, extended_msg))
+
   def test_ask_for_explicit_yes_true(self):
+    mock.patch('sys.stdin', StringIO('blah\nye\n')).start()
+    mock.patch('sys.stdout', StringIO()).start()
     self.assertTrue(git_cl.ask_for_explicit_yes('prompt'))
     self.assertEqual(
         'prompt [Yes/No]: Please, type yes or no: ',
@@ -654,15 +957,9 @@ class TestGitCl(unittest.TestCase):
       ]
 
     if issue:
-      gerrit_util.GetChangeDetail.return_value = {
-        'owner': {'email': (other_cl_owner or 'owner@example.com')},
-        'change_id': (change_id or '123456789'),
-        'current_revision': 'sha1_of_current_revision',
-        'revisions': {'sha1_of_current_revision': {
-          'commit': {'message': fetched_description},
-        }},
-        'status': fetched_status or 'NEW',
-      }
+      gerrit_util.GetChangeDetail.return_value = _get_change_detail(
+          fetched_description, fetched_status or 'NEW',
+          other_cl_owner or 'owner@example.com', change_id or '123456789')
       if fetched_status == 'ABANDONED':
         return calls
       if other_cl_owner:
@@ -687,10 +984,13 @@ class TestGitCl(unittest.TestCase):
                            short_hostname='chromium',
                            labels=None, change_id=None,
                            final_description=None, gitcookies_exists=True,
-                           force=False, edit_description=None):
+                           force=False, edit_description=None,
+                           include_trace_calls=True):
     if post_amend_description is None:
       post_amend_description = description
     cc = cc or []
+    git_host = '%s.googlesource.com' % short_hostname
+    review_host = '%s-review.googlesource.com' % short_hostname
 
     calls = []
 
@@ -698,7 +998,7 @@ class TestGitCl(unittest.TestCase):
       self.mockGit.config['gerrit.override-squash-uploads'] = (
           'true' if squash_mode == 'override_squash' else 'false')
 
-    if not git_footers.get_footer_change_id(description) and not squash:
+    if not squash and not _has_change_id(description):
       calls += [
         (('DownloadGerritHook', False), ''),
       ]
@@ -724,7 +1024,7 @@ class TestGitCl(unittest.TestCase):
         calls += [
           ((['git', 'merge-base', '--is-ancestor', custom_cl_base,
              'refs/remotes/origin/master'],),
-           callError(1)),   # Means not ancenstor.
+           CERR1),   # Means not ancenstor.
           (('ask_for_data',
             'Do you take responsibility for cleaning up potential mess '
             'resulting from proceeding with upload? Press Enter to upload, '
@@ -733,7 +1033,7 @@ class TestGitCl(unittest.TestCase):
         parent = custom_cl_base
 
       calls += [
-        ((['git', 'rev-parse', 'HEAD:'],),  # `HEAD:` means HEAD's tree hash.
+        (_GIT_REV_PARSE_HEAD_TREE,  # `HEAD:` means HEAD's tree hash.
          '0123456789abcdef'),
         ((['FileWrite', '/tmp/fake-temp1', description],), None),
         ((['git', 'commit-tree', '0123456789abcdef', '-p', parent,
@@ -752,14 +1052,14 @@ class TestGitCl(unittest.TestCase):
     metrics_arguments = []
 
     if notify:
-      ref_suffix = '%ready,notify=ALL'
+      ref_params = ['ready', 'notify=ALL']
       metrics_arguments += ['ready', 'notify=ALL']
     else:
       if not issue and squash:
-        ref_suffix = '%wip'
+        ref_params = ['wip']
         metrics_arguments.append('wip')
       else:
-        ref_suffix = '%notify=NONE'
+        ref_params = ['notify=NONE']
         metrics_arguments.append('notify=NONE')
 
     # If issue is given, then description is fetched from Gerrit instead.
@@ -769,65 +1069,64 @@ class TestGitCl(unittest.TestCase):
     else:
       if not title:
         calls += [
-          ((['git', 'show', '-s', '--format=%s', 'HEAD'],), ''),
+          (_GIT_SHOW_SUBJECT, ''),
           (('ask_for_data', 'Title for patchset []: '), 'User input'),
         ]
         title = 'User input'
     if title:
-      ref_suffix += ',m=' + gerrit_util.PercentEncodeForGitRef(title)
+      ref_params.append('m=' + gerrit_util.PercentEncodeForGitRef(title))
       metrics_arguments.append('m')
 
     if short_hostname == 'chromium':
       # All reviewers and ccs get into ref_suffix.
-      for r in sorted(reviewers):
-        ref_suffix += ',r=%s' % r
-        metrics_arguments.append('r')
+      ref_params.extend('r=%s' % r for r in sorted(reviewers))
+      metrics_arguments.extend('r' for _ in reviewers)
       if issue is None:
         cc += ['test-more-cc@chromium.org', 'joe@example.com']
-      for c in sorted(cc):
-        ref_suffix += ',cc=%s' % c
-        metrics_arguments.append('cc')
+      ref_params.extend('cc=%s' % c for c in sorted(cc))
+      metrics_arguments.extend('cc' for _ in cc)
       reviewers, cc = [], []
     else:
       # TODO(crbug/877717): remove this case.
+      sorted_reviewers = sorted(reviewers)
       calls += [
-        (('ValidAccounts', '%s-review.googlesource.com' % short_hostname,
-          sorted(reviewers) + ['joe@example.com',
+        (('ValidAccounts', review_host,
+          sorted_reviewers + ['joe@example.com',
           'test-more-cc@chromium.org'] + cc),
          {
            e: {'email': e}
            for e in (reviewers + ['joe@example.com'] + cc)
          })
       ]
-      for r in sorted(reviewers):
+      for r in sorted_reviewers:
         if r != 'bad-account-or-email':
-          ref_suffix  += ',r=%s' % r
+          ref_params.append('r=%s' % r)
           metrics_arguments.append('r')
           reviewers.remove(r)
       if issue is None:
         cc += ['joe@example.com']
       for c in sorted(cc):
-        ref_suffix += ',cc=%s' % c
+        ref_params.append('cc=%s' % c)
         metrics_arguments.append('cc')
         if c in cc:
           cc.remove(c)
 
-    for k, v in sorted((labels or {}).items()):
-      ref_suffix += ',l=%s+%d' % (k, v)
-      metrics_arguments.append('l=%s+%d' % (k, v))
+    label_params = [
+        'l=%s+%d' % (k, v) for k, v in sorted((labels or {}).items())]
+    ref_params.extend(label_params)
+    metrics_arguments.extend(label_params)
+    ref_suffix = '%' + ','.join(ref_params)
 
     if tbr:
       calls += [
-        (('GetCodeReviewTbrScore',
-          '%s-review.googlesource.com' % short_hostname,
-          'my/repo'),
+        (('GetCodeReviewTbrScore', review_host, 'my/repo'),
          2,),
       ]
 
     calls += [
       (('time.time',), 1000,),
       ((['git', 'push',
-         'https://%s.googlesource.com/my/repo' % short_hostname,
+         'https://%s/my/repo' % git_host,
          ref_to_push + ':refs/for/refs/heads/master' + ref_suffix],),
        (('remote:\n'
          'remote: Processing changes: (\)\n'
@@ -838,12 +1137,11 @@ class TestGitCl(unittest.TestCase):
          'remote: Processing changes: new: 1, done\n'
          'remote:\n'
          'remote: New Changes:\n'
-         'remote:   https://%s-review.googlesource.com/#/c/my/repo/+/123456'
-             ' XXX\n'
+         'remote:   https://%s/#/c/my/repo/+/123456 XXX\n'
          'remote:\n'
-         'To https://%s.googlesource.com/my/repo\n'
+         'To https://%s/my/repo\n'
          ' * [new branch]      hhhh -> refs/for/refs/heads/master\n'
-         ) % (short_hostname, short_hostname)),),
+         ) % (review_host, git_host)),),
       (('time.time',), 2000,),
       (('add_repeated',
         'sub_commands',
@@ -856,97 +1154,39 @@ class TestGitCl(unittest.TestCase):
         None,),
     ]
 
-    final_description = final_description or post_amend_description.strip()
+    if include_trace_calls:
+      final_description = final_description or post_amend_description.strip()
 
-    trace_name = os.path.join('TRACES_DIR', '20170316T200041.000000')
+      trace_name = _TRACE_NAME
 
-    # Trace-related calls
-    calls += [
-        # Write a description with context for the current trace.
-        (
-            ([
-                'FileWrite', trace_name + '-README',
-                '%(date)s\n'
-                '%(short_hostname)s-review.googlesource.com\n'
-                '%(change_id)s\n'
-                '%(title)s\n'
-                '%(description)s\n'
-                '1000\n'
-                '0\n'
-                '%(trace_name)s' % {
-                    'date': '2017-03-16T20:00:41.000000',
-                    'short_hostname': short_hostname,
-                    'change_id': change_id,
-                    'description': final_description,
-                    'title': title or '<untitled>',
-                    'trace_name': trace_name,
-                }
-            ], ),
-            None,
-        ),
-        # Read traces and shorten git hashes.
-        (
-            (['os.path.isfile',
-              os.path.join('TEMP_DIR', 'trace-packet')], ),
-            True,
-        ),
-        (
-            (['FileRead', os.path.join('TEMP_DIR', 'trace-packet')], ),
-            ('git-hash: 0123456789012345678901234567890123456789\n'
-             'git-hash: abcdeabcdeabcdeabcdeabcdeabcdeabcdeabcde\n'),
-        ),
-        (
-            ([
-                'FileWrite',
-                os.path.join('TEMP_DIR', 'trace-packet'), 'git-hash: 012345\n'
-                'git-hash: abcdea\n'
-            ], ),
-            None,
-        ),
-        # Make zip file for the git traces.
-        (
-            (['make_archive', trace_name + '-traces', 'zip', 'TEMP_DIR'], ),
-            None,
-        ),
-        # Collect git config and gitcookies.
-        (
-            (['git', 'config', '-l'], ),
-            'git-config-output',
-        ),
-        (
-            ([
-                'FileWrite',
-                os.path.join('TEMP_DIR', 'git-config'), 'git-config-output'
-            ], ),
-            None,
-        ),
-        (
-            (['os.path.isfile',
-              os.path.join('~', '.gitcookies')], ),
-            gitcookies_exists,
-        ),
-    ]
-    if gitcookies_exists:
+      # Trace-related calls
       calls += [
-          (
-              (['FileRead', os.path.join('~', '.gitcookies')], ),
-              'gitcookies 1/SECRET',
-          ),
+          # Write a description with context for the current trace.
           (
               ([
-                  'FileWrite',
-                  os.path.join('TEMP_DIR', 'gitcookies'), 'gitcookies REDACTED'
+                  'FileWrite', trace_name + '-README',
+                  _TRACE_README % {
+                      'gerrit_host': review_host,
+                      'change_id': change_id,
+                      'description': final_description,
+                      'title': title or '<untitled>',
+                  }
               ], ),
               None,
           ),
       ]
-    calls += [
-        # Make zip file for the git config and gitcookies.
-        (
-            (['make_archive', trace_name + '-git-info', 'zip', 'TEMP_DIR'], ),
-            None,
-        ),
-    ]
+      calls.extend(_TRACE_CALLS)
+      calls.append(
+          ((['os.path.isfile', _GITCOOKIES_PATH], ), gitcookies_exists))
+      if gitcookies_exists:
+        calls.extend(_GITCOOKIES_TRACE_CALLS)
+      calls += [
+          # Make zip file for the git config and gitcookies.
+          (
+              (['make_archive', trace_name + '-git-info', 'zip', 'TEMP_DIR'], ),
+              None,
+          ),
+      ]
 
     # TODO(crbug/877717): this should never be used.
     if squash and short_hostname != 'chromium':
@@ -960,6 +1200,48 @@ class TestGitCl(unittest.TestCase):
       ]
     return calls
 
+  # Patches shared by all the upload flow tests.
+  _UPLOAD_PATCHERS = (
+      mock.patch(
+          'git_cl.gerrit_util.CookiesAuthenticator',
+          CookiesAuthenticatorMockFactory(
+              same_auth=('git-owner.example.com', '', 'pass'))),
+      mock.patch(
+          'git_cl.Changelist._GerritCommitMsgHookCheck',
+          lambda _, offer_removal: None),
+      mock.patch(
+          'git_cl.datetime_now',
+          lambda: datetime.datetime(2017, 3, 16, 20, 0, 41, 0)),
+      mock.patch('git_cl.tempfile.mkdtemp', lambda: 'TEMP_DIR'),
+      mock.patch('git_cl.TRACES_DIR', 'TRACES_DIR'),
+      mock.patch(
+          'git_cl.TRACES_README_FORMAT',
+          '%(now)s\n'
+          '%(gerrit_host)s\n'
+          '%(change_id)s\n'
+          '%(title)s\n'
+          '%(description)s\n'
+          '%(execution_time)s\n'
+          '%(exit_code)s\n'
+          '%(trace_name)s'),
+      # The return values of these depend on the test, and are set by
+      # _run_gerrit_upload_test.
+      mock.patch('git_cl._create_description_from_log'),
+      mock.patch('git_cl.Changelist._AddChangeIdToCommitMessage'),
+      mock.patch('git_cl.GenerateGerritChangeId'),
+  )
+
+  # The temporary files of an upload are numbered from 1 in every test.
+  _TEMPORARY_FILE = TemporaryFileMock()
+  _TEMPORARY_FILE_PATCHER = mock.patch(
+      'gclient_utils.temporary_file', _TEMPORARY_FILE)
+
+  # Git config all the upload flow tests start from.
+  _UPLOAD_GIT_CONFIG = {
+      'gerrit.host': 'true',
+      'user.email': 'me@example.com',
+  }
+
   def _run_gerrit_upload_test(
       self,
       upload_args,
@@ -984,8 +1266,13 @@ class TestGitCl(unittest.TestCase):
       force=False,
       log_description=None,
       edit_description=None,
-      fetched_description=None):
-    """Generic gerrit upload test framework."""
+      fetched_description=None,
+      include_trace_calls=True):
+    """Generic gerrit upload test framework.
+
+    Tests which don't care about the traces git cl upload collects can pass
+    include_trace_calls=False to not write, nor expect, them.
+    """
     if squash_mode is None:
       if '--no-squash' in upload_args:
         squash_mode = 'nosquash'
@@ -996,11 +1283,8 @@ class TestGitCl(unittest.TestCase):
 
     reviewers = reviewers or []
     cc = cc or []
-    mock.patch('git_cl.gerrit_util.CookiesAuthenticator',
-              CookiesAuthenticatorMockFactory(
-                same_auth=('git-owner.example.com', '', 'pass'))).start()
-    mock.patch('git_cl.Changelist._GerritCommitMsgHookCheck',
-              lambda _, offer_removal: None).start()
+    for patcher in self._UPLOAD_PATCHERS:
+      patcher.start()
     mock.patch('git_cl.gclient_utils.RunEditor',
               lambda *_, **__: self._mocked_call(['RunEditor'])).start()
     mock.patch('git_cl.DownloadGerritHook', lambda force: self._mocked_call(
@@ -1010,42 +1294,26 @@ class TestGitCl(unittest.TestCase):
     mock.patch('git_cl.gclient_utils.FileWrite',
               lambda path, contents: self._mocked_call(
                   ['FileWrite', path, contents])).start()
-    mock.patch('git_cl.datetime_now',
-             lambda: datetime.datetime(2017, 3, 16, 20, 0, 41, 0)).start()
-    mock.patch('git_cl.tempfile.mkdtemp', lambda: 'TEMP_DIR').start()
-    mock.patch('git_cl.TRACES_DIR', 'TRACES_DIR').start()
-    mock.patch('git_cl.TRACES_README_FORMAT',
-              '%(now)s\n'
-              '%(gerrit_host)s\n'
-              '%(change_id)s\n'
-              '%(title)s\n'
-              '%(description)s\n'
-              '%(execution_time)s\n'
-              '%(exit_code)s\n'
-              '%(trace_name)s').start()
     mock.patch('git_cl.shutil.make_archive',
               lambda *args: self._mocked_call(['make_archive'] +
               list(args))).start()
     mock.patch('os.path.isfile',
               lambda path: self._mocked_call(['os.path.isfile', path])).start()
-    mock.patch(
-        'git_cl._create_description_from_log',
-        return_value=log_description or description).start()
-    mock.patch(
-        'git_cl.Changelist._AddChangeIdToCommitMessage',
-        return_value=post_amend_description or description).start()
-    mock.patch(
-        'git_cl.GenerateGerritChangeId', return_value=change_id).start()
+    git_cl._create_description_from_log.return_value = (
+        log_description or description)
+    git_cl.Changelist._AddChangeIdToCommitMessage.return_value = (
+        post_amend_description or description)
+    git_cl.GenerateGerritChangeId.return_value = change_id
     mock.patch(
         'gclient_utils.AskForData',
         lambda prompt: self._mocked_call('ask_for_data', prompt)).start()
 
-    self.mockGit.config['gerrit.host'] = 'true'
-    self.mockGit.config['branch.master.gerritissue'] = (
-        str(issue) if issue else None)
-    self.mockGit.config['remote.origin.url'] = (
-        'https://%s.googlesource.com/my/repo' % short_hostname)
-    self.mockGit.config['user.email'] = 'me@example.com'
+    self.mockGit.config.update(self._UPLOAD_GIT_CONFIG)
+    self.mockGit.config.update({
+        'branch.master.gerritissue': str(issue) if issue else None,
+        'remote.origin.url': (
+            'https://%s.googlesource.com/my/repo' % short_hostname),
+    })
 
     self.calls = self._gerrit_base_calls(
         issue=issue,
@@ -1056,8 +1324,8 @@ class TestGitCl(unittest.TestCase):
         short_hostname=short_hostname,
         change_id=change_id)
     if fetched_status != 'ABANDONED':
-      mock.patch(
-          'gclient_utils.temporary_file', TemporaryFileMock()).start()
+      self._TEMPORARY_FILE.reset()
+      self._TEMPORARY_FILE_PATCHER.start()
       mock.patch('os.remove', return_value=True).start()
       self.calls += self._gerrit_upload_calls(
           description, reviewers, squash,
@@ -1072,7 +1340,10 @@ class TestGitCl(unittest.TestCase):
           final_description=final_description,
           gitcookies_exists=gitcookies_exists,
           force=force,
-          edit_description=edit_description)
+          edit_description=edit_description,
+          include_trace_calls=include_trace_calls)
+    if not include_trace_calls:
+      mock.patch('git_cl.Changelist._WriteGitPushTraces').start()
     # Uncomment when debugging.
     # print('\n'.join(map(lambda x: '%2i: %s' % x, enumerate(self.calls))))
     git_cl.main(['upload'] + upload_args)
@@ -1207,7 +1478,8 @@ class TestGitCl(unittest.TestCase):
         [],
         'desc ✔\nBUG=\n\nChange-Id: 123456789',
         [],
-        change_id='123456789')
+        change_id='123456789',
+        include_trace_calls=False)
 
   def test_gerrit_upload_squash_first(self):
     self._run_gerrit_upload_test(
@@ -1215,7 +1487,8 @@ class TestGitCl(unittest.TestCase):
         'desc ✔\nBUG=\n\nChange-Id: 123456789',
         [],
         squash=True,
-        change_id='123456789')
+        change_id='123456789',
+        include_trace_calls=False)
 
   def test_gerrit_upload_squash_first_title(self):
     self._run_gerrit_upload_test(
@@ -1234,9 +1507,11 @@ class TestGitCl(unittest.TestCase):
         [],
         squash=True,
         labels={'Commit-Queue': 1, 'Auto-Submit': 1},
-        change_id='123456789')
+        change_id='123456789',
+        include_trace_calls=False)
 
   def test_gerrit_upload_squash_first_against_rev(self):
+    mock.patch('sys.stdout', StringIO()).start()
     custom_cl_base = 'custom_cl_base_rev_or_branch'
     self._run_gerrit_upload_test(
         ['--squash', custom_cl_base],
@@ -1257,10 +1532,11 @@ class TestGitCl(unittest.TestCase):
         [],
         squash=True,
         issue=123456,
-        change_id='123456789')
+        change_id='123456789',
+        include_trace_calls=False)
 
-  @mock.patch('sys.stderr', StringIO())
   def test_gerrit_upload_squash_reupload_to_abandoned(self):
+    mock.patch('sys.stderr', StringIO()).start()
     description = 'desc ✔\nBUG=\n\nChange-Id: 123456789'
     with self.assertRaises(SystemExitMock):
       self._run_gerrit_upload_test(
@@ -1280,6 +1556,7 @@ class TestGitCl(unittest.TestCase):
       'gerrit_util.GetAccountDetails',
       return_value={'email': 'yet-another@example.com'})
   def test_gerrit_upload_squash_reupload_to_not_owned(self, _mock):
+    mock.patch('sys.stdout', StringIO()).start()
     description = 'desc ✔\nBUG=\n\nChange-Id: 123456789'
     self._run_gerrit_upload_test(
           ['--squash'],
@@ -1310,27 +1587,14 @@ class TestGitCl(unittest.TestCase):
 
   @mock.patch('git_cl.RunGit')
   @mock.patch('git_cl.CMDupload')
-  @mock.patch('sys.stdin', StringIO('\n'))
-  @mock.patch('sys.stdout', StringIO())
   def test_upload_branch_deps(self, *_mocks):
+    mock.patch('sys.stdin', StringIO('\n')).start()
+    mock.patch('sys.stdout', StringIO()).start()
     def mock_run_git(*args, **_kwargs):
       if args[0] == ['for-each-ref',
                        '--format=%(refname:short) %(upstream:short)',
                        'refs/heads']:
-        # Create a local branch dependency tree that looks like this:
-        # test1 -> test2 -> test3   -> test4 -> test5
-        #                -> test3.1
-        # test6 -> test0
-        branch_deps = [
-            'test2 test1',    # test1 -> test2
-            'test3 test2',    # test2 -> test3
-            'test3.1 test2',  # test2 -> test3.1
-            'test4 test3',    # test3 -> test4
-            'test5 test4',    # test4 -> test5
-            'test6 test0',    # test0 -> test6
-            'test7',          # test7
-        ]
-        return '\n'.join(branch_deps)
+        return _BRANCH_DEPS
     git_cl.RunGit.side_effect = mock_run_git
     git_cl.CMDupload.return_value = 0
 
@@ -1481,52 +1745,50 @@ class TestGitCl(unittest.TestCase):
           expected,
           'GetHashTags(%r) == %r, expected %r' % (desc, actual, expected))
 
-    self.assertEqual(None, git_cl.GetTargetRef('origin', None, 'master'))
-    self.assertEqual(None, git_cl.GetTargetRef(None,
-                                               'refs/remotes/origin/master',
-                                               'master'))
-
-    # Check default target refs for branches.
-    self.assertEqual('refs/heads/master',
-                     git_cl.GetTargetRef('origin', 'refs/remotes/origin/master',
-                                         None))
-    self.assertEqual('refs/heads/master',
-                     git_cl.GetTargetRef('origin', 'refs/remotes/origin/lkgr',
-                                         None))
-    self.assertEqual('refs/heads/master',
-                     git_cl.GetTargetRef('origin', 'refs/remotes/origin/lkcr',
-                                         None))
-    self.assertEqual('refs/branch-heads/123',
-                     git_cl.GetTargetRef('origin',
-                                         'refs/remotes/branch-heads/123',
-                                         None))
-    self.assertEqual('refs/diff/test',
-                     git_cl.GetTargetRef('origin',
-                                         'refs/remotes/origin/refs/diff/test',
-                                         None))
-    self.assertEqual('refs/heads/chrome/m42',
-                     git_cl.GetTargetRef('origin',
-                                         'refs/remotes/origin/chrome/m42',
-                                         None))
-
-    # Check target refs for user-specified target branch.
-    for branch in ('branch-heads/123', 'remotes/branch-heads/123',
-                   'refs/remotes/branch-heads/123'):
-      self.assertEqual('refs/branch-heads/123',
-                       git_cl.GetTargetRef('origin',
-                                           'refs/remotes/origin/master',
-                                           branch))
-    for branch in ('origin/master', 'remotes/origin/master',
-                   'refs/remotes/origin/master'):
-      self.assertEqual('refs/heads/master',
-                       git_cl.GetTargetRef('origin',
-                                           'refs/remotes/branch-heads/123',
-                                           branch))
-    for branch in ('master', 'heads/master', 'refs/heads/master'):
-      self.assertEqual('refs/heads/master',
-                       git_cl.GetTargetRef('origin',
-                                           'refs/remotes/branch-heads/123',
-                                           branch))
+  def test_get_target_ref(self):
+    # (remote, upstream branch, target branch, expected target ref).
+    cases = (
+      ('origin', None, 'master', None),
+      (None, 'refs/remotes/origin/master', 'master', None),
+
+      # Default target refs for branches.
+      ('origin', 'refs/remotes/origin/master', None, 'refs/heads/master'),
+      ('origin', 'refs/remotes/origin/lkgr', None, 'refs/heads/master'),
+      ('origin', 'refs/remotes/origin/lkcr', None, 'refs/heads/master'),
+      ('origin', 'refs/remotes/branch-heads/123', None,
+       'refs/branch-heads/123'),
+      ('origin', 'refs/remotes/origin/refs/diff/test', None,
+       'refs/diff/test'),
+      ('origin', 'refs/remotes/origin/chrome/m42', None,
+       'refs/heads/chrome/m42'),
+
+      # Target refs for user-specified target branch.
+      ('origin', 'refs/remotes/origin/master', 'branch-heads/123',
+       'refs/branch-heads/123'),
+      ('origin', 'refs/remotes/origin/master', 'remotes/branch-heads/123',
+       'refs/branch-heads/123'),
+      ('origin', 'refs/remotes/origin/master',
+       'refs/remotes/branch-heads/123', 'refs/branch-heads/123'),
+      ('origin', 'refs/remotes/branch-heads/123', 'origin/master',
+       'refs/heads/master'),
+      ('origin', 'refs/remotes/branch-heads/123', 'remotes/origin/master',
+       'refs/heads/master'),
+      ('origin', 'refs/remotes/branch-heads/123',
+       'refs/remotes/origin/master', 'refs/heads/master'),
+      ('origin', 'refs/remotes/branch-heads/123', 'master',
+       'refs/heads/master'),
+      ('origin', 'refs/remotes/branch-heads/123', 'heads/master',
+       'refs/heads/master'),
+      ('origin', 'refs/remotes/branch-heads/123', 'refs/heads/master',
+       'refs/heads/master'),
+    )
+    for remote, remote_branch, target_branch, expected in cases:
+      actual = git_cl.GetTargetRef(remote, remote_branch, target_branch)
+      self.assertEqual(
+          actual,
+          expected,
+          'GetTargetRef(%r, %r, %r) == %r, expected %r' % (
+              remote, remote_branch, target_branch, actual, expected))
 
   @mock.patch('git_common.is_dirty_git_tree', return_value=True)
   def test_patch_when_dirty(self, *_mocks):
@@ -1548,25 +1810,8 @@ class TestGitCl(unittest.TestCase):
     mock.patch('scm.GIT.ResolveCommit', return_value='deadbeef').start()
     self.mockGit.config['remote.origin.url'] = (
         'https://%s.googlesource.com/my/repo' % git_short_host)
-    gerrit_util.GetChangeDetail.return_value = {
-      'current_revision': '7777777777',
-      'revisions': {
-        '1111111111': {
-          '_number': 1,
-          'fetch': {'http': {
-            'url': 'https://%s.googlesource.com/my/repo' % git_short_host,
-            'ref': 'refs/changes/56/123456/1',
-          }},
-        },
-        '7777777777': {
-          '_number': 7,
-          'fetch': {'http': {
-            'url': 'https://%s.googlesource.com/my/repo' % git_short_host,
-            'ref': 'refs/changes/56/123456/7',
-          }},
-        },
-      },
-    }
+    gerrit_util.GetChangeDetail.return_value = _get_patch_change_detail(
+        git_short_host)
 
   def test_patch_gerrit_default(self):
     self._patch_common()
@@ -1621,8 +1866,8 @@ class TestGitCl(unittest.TestCase):
       0)
     self.assertIssueAndPatchset(patchset='1', git_short_host='else')
 
-  @mock.patch('sys.stderr', StringIO())
   def test_patch_gerrit_conflict(self):
+    mock.patch('sys.stderr', StringIO()).start()
     self._patch_common()
     self.calls += [
       ((['git', 'fetch', 'https://chromium.googlesource.com/my/repo',
@@ -1638,8 +1883,8 @@ class TestGitCl(unittest.TestCase):
   @mock.patch(
       'gerrit_util.GetChangeDetail',
       side_effect=gerrit_util.GerritError(404, ''))
-  @mock.patch('sys.stderr', StringIO())
   def test_patch_gerrit_not_exists(self, *_mocks):
+    mock.patch('sys.stderr', StringIO()).start()
     self.mockGit.config['remote.origin.url'] = (
         'https://chromium.googlesource.com/my/repo')
     with self.assertRaises(SystemExitMock):
@@ -1680,8 +1925,8 @@ class TestGitCl(unittest.TestCase):
     mock.patch(
         'gclient_utils.AskForData',
         lambda prompt: self._mocked_call('ask_for_data', prompt)).start()
-    mock.patch('git_cl.gerrit_util.CookiesAuthenticator',
-              CookiesAuthenticatorMockFactory(hosts_with_creds=auth)).start()
+    self._swap(git_cl.gerrit_util, 'CookiesAuthenticator',
+               CookiesAuthenticatorMockFactory(hosts_with_creds=auth))
     self.mockGit.config['remote.origin.url'] = (
         'https://chromium.googlesource.com/my/repo')
     cl = git_cl.Changelist()
@@ -1689,23 +1934,14 @@ class TestGitCl(unittest.TestCase):
     cl.branchref = 'refs/heads/master'
     return cl
 
-  @mock.patch('sys.stderr', StringIO())
   def test_gerrit_ensure_authenticated_missing(self):
+    mock.patch('sys.stderr', StringIO()).start()
     cl = self._test_gerrit_ensure_authenticated_common(auth={
       'chromium.googlesource.com': ('git-is.ok', '', 'but gerrit is missing'),
     })
     with self.assertRaises(SystemExitMock):
       cl.EnsureAuthenticated(force=False)
-    self.assertEqual(
-        'Credentials for the following hosts are required:\n'
-        '  chromium-review.googlesource.com\n'
-        'These are read from ~%(sep)s.gitcookies '
-        '(or legacy ~%(sep)s%(netrc)s)\n'
-        'You can (re)generate your credentials by visiting '
-        'https://chromium-review.googlesource.com/new-password\n' % {
-            'sep': os.sep,
-            'netrc': NETRC_FILENAME,
-        }, sys.stderr.getvalue())
+    self.assertEqual(_MISSING_CREDS_MESSAGE, sys.stderr.getvalue())
 
   def test_gerrit_ensure_authenticated_conflict(self):
     cl = self._test_gerrit_ensure_authenticated_common(auth={
@@ -1755,10 +1991,10 @@ class TestGitCl(unittest.TestCase):
               'remote': 'custom-scheme://repo'}
           ), None),
     ]
-    mock.patch('git_cl.gerrit_util.CookiesAuthenticator',
-              CookiesAuthenticatorMockFactory(hosts_with_creds={})).start()
-    mock.patch('logging.warning',
-              lambda *a: self._mocked_call('logging.warning', *a)).start()
+    self._swap(git_cl.gerrit_util, 'CookiesAuthenticator',
+               NoCredsCookiesAuthenticatorMock)
+    self._swap(logging, 'warning',
+               lambda *a: self._mocked_call('logging.warning', *a))
     cl = git_cl.Changelist()
     cl.branch = 'master'
     cl.branchref = 'refs/heads/master'
@@ -1777,49 +2013,49 @@ class TestGitCl(unittest.TestCase):
               'url': 'git@somehost.example:foo/bar.git'}
           ), None),
     ]
-    mock.patch('git_cl.gerrit_util.CookiesAuthenticator',
-              CookiesAuthenticatorMockFactory(hosts_with_creds={})).start()
-    mock.patch('logging.error',
-              lambda *a: self._mocked_call('logging.error', *a)).start()
+    self._swap(git_cl.gerrit_util, 'CookiesAuthenticator',
+               NoCredsCookiesAuthenticatorMock)
+    self._swap(logging, 'error',
+               lambda *a: self._mocked_call('logging.error', *a))
     cl = git_cl.Changelist()
     cl.branch = 'master'
     cl.branchref = 'refs/heads/master'
     cl.lookedup_issue = True
     self.assertIsNone(cl.EnsureAuthenticated(force=False))
 
-  def _cmd_set_commit_gerrit_common(self, vote, notify=None):
-    self.mockGit.config['branch.master.gerritissue'] = '123'
-    self.mockGit.config['branch.master.gerritserver'] = (
-        'https://chromium-review.googlesource.com')
-    self.mockGit.config['remote.origin.url'] = (
-        'https://chromium.googlesource.com/infra/infra')
-    self.calls = [
-        (('SetReview', 'chromium-review.googlesource.com',
-          'infra%2Finfra~123', None,
-          {'Commit-Queue': vote}, notify, None), ''),
-    ]
-
-  def test_cmd_set_commit_gerrit_clear(self):
-    self._cmd_set_commit_gerrit_common(0)
-    self.assertEqual(0, git_cl.main(['set-commit', '-c']))
-
-  def test_cmd_set_commit_gerrit_dry(self):
-    self._cmd_set_commit_gerrit_common(1, notify=False)
-    self.assertEqual(0, git_cl.main(['set-commit', '-d']))
-
   def test_cmd_set_commit_gerrit(self):
-    self._cmd_set_commit_gerrit_common(2)
-    self.assertEqual(0, git_cl.main(['set-commit']))
+    self.mockGit.config.update({
+        'branch.master.gerritissue': '123',
+        'branch.master.gerritserver': (
+            'https://chromium-review.googlesource.com'),
+        'remote.origin.url': 'https://chromium.googlesource.com/infra/infra',
+    })
+    # (arguments, expected Commit-Queue vote, expected notify). The three
+    # modes share their setup, so they run in a single test.
+    cases = (
+      (['set-commit', '-c'], 0, None),
+      (['set-commit', '-d'], 1, False),
+      (['set-commit'], 2, None),
+    )
+    for args, vote, notify in cases:
+      self.calls = [
+          (('SetReview', 'chromium-review.googlesource.com',
+            'infra%2Finfra~123', None,
+            {'Commit-Queue': vote}, notify, None), ''),
+      ]
+      self.assertEqual(0, git_cl.main(args), args)
+      self.assertFalse(self.calls, args)
 
   def test_description_display(self):
-    mock.patch('git_cl.Changelist', ChangelistMock).start()
+    mock.patch('sys.stdout', StringIO()).start()
+    self._swap(git_cl, 'Changelist', ChangelistMock)
     ChangelistMock.desc = 'foo\n'
 
     self.assertEqual(0, git_cl.main(['description', '-d']))
     self.assertEqual('foo\n', sys.stdout.getvalue())
 
-  @mock.patch('sys.stderr', StringIO())
   def test_StatusFieldOverrideIssueMissingArgs(self):
+    mock.patch('sys.stderr', StringIO()).start()
     try:
       self.assertEqual(git_cl.main(['status', '--issue', '1']), 0)
     except SystemExitMock:
@@ -1827,11 +2063,12 @@ class TestGitCl(unittest.TestCase):
           '--field must be given when --issue is set.', sys.stderr.getvalue())
 
   def test_StatusFieldOverrideIssue(self):
+    mock.patch('sys.stdout', StringIO()).start()
     def assertIssue(cl_self, *_args):
       self.assertEqual(cl_self.issue, 1)
       return 'foobar'
 
-    mock.patch('git_cl.Changelist.FetchDescription', assertIssue).start()
+    self._swap(git_cl.Changelist, 'FetchDescription', assertIssue)
     self.assertEqual(
       git_cl.main(['status', '--issue', '1', '--field', 'desc']),
       0)
@@ -1843,12 +2080,13 @@ class TestGitCl(unittest.TestCase):
       self.assertEqual(cl_self.issue, 1)
       return 'foobar'
 
-    mock.patch('git_cl.Changelist.FetchDescription', assertIssue).start()
-    mock.patch('git_cl.Changelist.CloseIssue', lambda *_: None).start()
+    self._swap(git_cl.Changelist, 'FetchDescription', assertIssue)
+    self._swap(git_cl.Changelist, 'CloseIssue', lambda *_: None)
     self.assertEqual(
       git_cl.main(['set-close', '--issue', '1']), 0)
 
   def test_description(self):
+    mock.patch('sys.stdout', StringIO()).start()
     self.mockGit.config['remote.origin.url'] = (
         'https://chromium.googlesource.com/my/repo')
     gerrit_util.GetChangeDetail.return_value = {
@@ -1864,81 +2102,91 @@ class TestGitCl(unittest.TestCase):
     self.assertEqual('foobar\n', sys.stdout.getvalue())
 
   def test_description_set_raw(self):
-    mock.patch('git_cl.Changelist', ChangelistMock).start()
-    mock.patch('git_cl.sys.stdin', StringIO('hihi')).start()
+    self._swap(git_cl, 'Changelist', ChangelistMock)
+    self._swap(git_cl.sys, 'stdin', StringIO('hihi'))
 
     self.assertEqual(0, git_cl.main(['description', '-n', 'hihi']))
     self.assertEqual('hihi', ChangelistMock.desc)
 
-  def test_description_appends_bug_line(self):
-    current_desc = 'Some.\n\nChange-Id: xxx'
+  # The comment lines the description editor opens with.
+  _DESCRIPTION_EDITOR_HEADER = (
+      '# Enter a description of the change.\n'
+      '# This will be displayed on the codereview site.\n'
+      '# The first line will also be used as the subject of the review.\n'
+      '#--------------------This line is 72 characters long'
+      '--------------------\n')
+
+  def _run_description_edit_test(
+      self, current_desc, expected_editor_desc, edited_desc=None,
+      expected_update=None):
+    """Runs `git cl description` to edit a CL described by current_desc.
+
+    The editor must be opened on expected_editor_desc, and returns edited_desc,
+    or its input unchanged if None. expected_update is the description the CL
+    must then be updated with, or None if it must be left alone.
+    """
+    updates = []
 
     def RunEditor(desc, _, **kwargs):
       self.assertEqual(
-          '# Enter a description of the change.\n'
-          '# This will be displayed on the codereview site.\n'
-          '# The first line will also be used as the subject of the review.\n'
-          '#--------------------This line is 72 characters long'
-          '--------------------\n'
-          'Some.\n\nChange-Id: xxx\nBug: ',
-          desc)
-      # Simulate user changing something.
-      return 'Some.\n\nChange-Id: xxx\nBug: 123'
-
-    def UpdateDescription(_, desc, force=False):
-      self.assertEqual(desc, 'Some.\n\nChange-Id: xxx\nBug: 123')
+          self._DESCRIPTION_EDITOR_HEADER + expected_editor_desc, desc)
+      return desc if edited_desc is None else edited_desc
 
-    mock.patch('git_cl.Changelist.FetchDescription',
-              lambda *args: current_desc).start()
-    mock.patch('git_cl.Changelist.UpdateDescription',
-              UpdateDescription).start()
-    mock.patch('git_cl.gclient_utils.RunEditor', RunEditor).start()
+    self._swap(
+        git_cl.Changelist, 'FetchDescription', lambda *args: current_desc)
+    self._swap(git_cl.Changelist, 'UpdateDescription',
+               lambda _, desc, force=False: updates.append(desc))
+    self._swap(git_cl.gclient_utils, 'RunEditor', RunEditor)
 
     self.mockGit.config['branch.master.gerritissue'] = '123'
     self.assertEqual(0, git_cl.main(['description']))
+    self.assertEqual([expected_update] if expected_update else [], updates)
 
-  def test_description_does_not_append_bug_line_if_fixed_is_present(self):
-    current_desc = 'Some.\n\nFixed: 123\nChange-Id: xxx'
-
-    def RunEditor(desc, _, **kwargs):
-      self.assertEqual(
-          '# Enter a description of the change.\n'
-          '# This will be displayed on the codereview site.\n'
-          '# The first line will also be used as the subject of the review.\n'
-          '#--------------------This line is 72 characters long'
-          '--------------------\n'
-          'Some.\n\nFixed: 123\nChange-Id: xxx',
-          desc)
-      return desc
-
-    mock.patch('git_cl.Changelist.FetchDescription',
-              lambda *args: current_desc).start()
-    mock.patch('git_cl.gclient_utils.RunEditor', RunEditor).start()
+  def test_description_appends_bug_line(self):
+    self._run_description_edit_test(
+        'Some.\n\nChange-Id: xxx',
+        'Some.\n\nChange-Id: xxx\nBug: ',
+        # Simulate user changing something.
+        edited_desc='Some.\n\nChange-Id: xxx\nBug: 123',
+        expected_update='Some.\n\nChange-Id: xxx\nBug: 123')
 
-    self.mockGit.config['branch.master.gerritissue'] = '123'
-    self.assertEqual(0, git_cl.main(['description']))
+  def test_description_does_not_append_bug_line_if_fixed_is_present(self):
+    self._run_description_edit_test(
+        'Some.\n\nFixed: 123\nChange-Id: xxx',
+        'Some.\n\nFixed: 123\nChange-Id: xxx')
 
   def test_description_set_stdin(self):
-    mock.patch('git_cl.Changelist', ChangelistMock).start()
-    mock.patch('git_cl.sys.stdin', StringIO('hi \r\n\t there\n\nman')).start()
+    self._swap(git_cl, 'Changelist', ChangelistMock)
+    self._swap(git_cl.sys, 'stdin', StringIO('hi \r\n\t there\n\nman'))
 
     self.assertEqual(0, git_cl.main(['description', '-n', '-']))
     self.assertEqual('hi\n\t there\n\nman', ChangelistMock.desc)
 
-  def test_archive(self):
-    self.calls = [
+  # The calls listing the branches and tags most of the archive tests start
+  # with.
+  _ARCHIVE_LIST_REFS_CALLS = (
       ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'],),
        'refs/heads/master\nrefs/heads/foo\nrefs/heads/bar'),
       ((['git', 'for-each-ref', '--format=%(refname)', 'refs/tags'],), ''),
+  )
+
+  # The statuses get_cl_statuses reports to most of the archive tests.
+  _ARCHIVE_STATUSES = (
+      (MockChangelistWithBranchAndIssue('master', 1), 'open'),
+      (MockChangelistWithBranchAndIssue('foo', 456), 'closed'),
+      (MockChangelistWithBranchAndIssue('bar', 789), 'open'),
+  )
+
+  def test_archive(self):
+    self.calls = self._ARCHIVE_LIST_REFS_CALLS
+    self.calls += [
       ((['git', 'tag', 'git-cl-archived-456-foo', 'foo'],), ''),
       ((['git', 'branch', '-D', 'foo'],), '')
     ]
 
-    mock.patch('git_cl.get_cl_statuses',
-              lambda branches, fine_grained, max_processes:
-              [(MockChangelistWithBranchAndIssue('master', 1), 'open'),
-               (MockChangelistWithBranchAndIssue('foo', 456), 'closed'),
-               (MockChangelistWithBranchAndIssue('bar', 789), 'open')]).start()
+    self._swap(git_cl, 'get_cl_statuses',
+               lambda branches, fine_grained, max_processes:
+               self._ARCHIVE_STATUSES)
 
     self.assertEqual(0, git_cl.main(['archive', '-f']))
 
@@ -1952,11 +2200,9 @@ class TestGitCl(unittest.TestCase):
       ((['git', 'branch', '-D', 'foo'],), '')
     ]
 
-    mock.patch('git_cl.get_cl_statuses',
-              lambda branches, fine_grained, max_processes:
-              [(MockChangelistWithBranchAndIssue('master', 1), 'open'),
-               (MockChangelistWithBranchAndIssue('foo', 456), 'closed'),
-               (MockChangelistWithBranchAndIssue('bar', 789), 'open')]).start()
+    self._swap(git_cl, 'get_cl_statuses',
+               lambda branches, fine_grained, max_processes:
+               self._ARCHIVE_STATUSES)
 
     self.assertEqual(0, git_cl.main(['archive', '-f']))
 
@@ -1975,41 +2221,29 @@ class TestGitCl(unittest.TestCase):
     self.assertEqual(1, git_cl.main(['archive', '-f']))
 
   def test_archive_dry_run(self):
-    self.calls = [
-      ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'],),
-         'refs/heads/master\nrefs/heads/foo\nrefs/heads/bar'),
-      ((['git', 'for-each-ref', '--format=%(refname)', 'refs/tags'],), ''),
-    ]
+    self.calls = self._ARCHIVE_LIST_REFS_CALLS
 
-    mock.patch('git_cl.get_cl_statuses',
-              lambda branches, fine_grained, max_processes:
-              [(MockChangelistWithBranchAndIssue('master', 1), 'open'),
-               (MockChangelistWithBranchAndIssue('foo', 456), 'closed'),
-               (MockChangelistWithBranchAndIssue('bar', 789), 'open')]).start()
+    self._swap(git_cl, 'get_cl_statuses',
+               lambda branches, fine_grained, max_processes:
+               self._ARCHIVE_STATUSES)
 
     self.assertEqual(0, git_cl.main(['archive', '-f', '--dry-run']))
 
   def test_archive_no_tags(self):
-    self.calls = [
-      ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'],),
-         'refs/heads/master\nrefs/heads/foo\nrefs/heads/bar'),
-      ((['git', 'for-each-ref', '--format=%(refname)', 'refs/tags'],), ''),
+    self.calls = self._ARCHIVE_LIST_REFS_CALLS
+    self.calls += [
       ((['git', 'branch', '-D', 'foo'],), '')
     ]
 
-    mock.patch('git_cl.get_cl_statuses',
-              lambda branches, fine_grained, max_processes:
-              [(MockChangelistWithBranchAndIssue('master', 1), 'open'),
-               (MockChangelistWithBranchAndIssue('foo', 456), 'closed'),
-               (MockChangelistWithBranchAndIssue('bar', 789), 'open')]).start()
+    self._swap(git_cl, 'get_cl_statuses',
+               lambda branches, fine_grained, max_processes:
+               self._ARCHIVE_STATUSES)
 
     self.assertEqual(0, git_cl.main(['archive', '-f', '--notags']))
 
   def test_archive_tag_cleanup_on_branch_deletion_error(self):
-    self.calls = [
-      ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'],),
-         'refs/heads/master\nrefs/heads/foo\nrefs/heads/bar'),
-      ((['git', 'for-each-ref', '--format=%(refname)', 'refs/tags'],), ''),
+    self.calls = self._ARCHIVE_LIST_REFS_CALLS
+    self.calls += [
       ((['git', 'tag', 'git-cl-archived-456-foo', 'foo'],),
         'refs/tags/git-cl-archived-456-foo'),
       ((['git', 'branch', '-D', 'foo'],), CERR1),
@@ -2017,19 +2251,15 @@ class TestGitCl(unittest.TestCase):
        'refs/tags/git-cl-archived-456-foo'),
     ]
 
-    mock.patch('git_cl.get_cl_statuses',
-              lambda branches, fine_grained, max_processes:
-              [(MockChangelistWithBranchAndIssue('master', 1), 'open'),
-               (MockChangelistWithBranchAndIssue('foo', 456), 'closed'),
-               (MockChangelistWithBranchAndIssue('bar', 789), 'open')]).start()
+    self._swap(git_cl, 'get_cl_statuses',
+               lambda branches, fine_grained, max_processes:
+               self._ARCHIVE_STATUSES)
 
     self.assertEqual(0, git_cl.main(['archive', '-f']))
 
   def test_archive_with_format(self):
-    self.calls = [
-        ((['git', 'for-each-ref', '--format=%(refname)', 'refs/heads'], ),
-         'refs/heads/master\nrefs/heads/foo\nrefs/heads/bar'),
-        ((['git', 'for-each-ref', '--format=%(refname)', 'refs/tags'], ), ''),
+    self.calls = self._ARCHIVE_LIST_REFS_CALLS
+    self.calls += [
         ((['git', 'tag', 'archived/12-foo', 'foo'], ), ''),
         ((['git', 'branch', '-D', 'foo'], ), ''),
     ]
@@ -2042,9 +2272,11 @@ class TestGitCl(unittest.TestCase):
         0, git_cl.main(['archive', '-f', '-p', 'archived/{issue}-{branch}']))
 
   def test_cmd_issue_erase_existing(self):
-    self.mockGit.config['branch.master.gerritissue'] = '123'
-    self.mockGit.config['branch.master.gerritserver'] = (
-         'https://chromium-review.googlesource.com')
+    self.mockGit.config.update({
+        'branch.master.gerritissue': '123',
+        'branch.master.gerritserver': (
+            'https://chromium-review.googlesource.com'),
+    })
     self.calls = [
         ((['git', 'log', '-1', '--format=%B'],), 'This is a description'),
     ]
@@ -2053,9 +2285,11 @@ class TestGitCl(unittest.TestCase):
     self.assertNotIn('branch.master.gerritserver', self.mockGit.config)
 
   def test_cmd_issue_erase_existing_with_change_id(self):
-    self.mockGit.config['branch.master.gerritissue'] = '123'
-    self.mockGit.config['branch.master.gerritserver'] = (
-         'https://chromium-review.googlesource.com')
+    self.mockGit.config.update({
+        'branch.master.gerritissue': '123',
+        'branch.master.gerritserver': (
+            'https://chromium-review.googlesource.com'),
+    })
     mock.patch('git_cl.Changelist.FetchDescription',
               lambda _: 'This is a description\n\nChange-Id: Ideadbeef').start()
     self.calls = [
@@ -2068,9 +2302,11 @@ class TestGitCl(unittest.TestCase):
     self.assertNotIn('branch.master.gerritserver', self.mockGit.config)
 
   def test_cmd_issue_json(self):
-    self.mockGit.config['branch.master.gerritissue'] = '123'
-    self.mockGit.config['branch.master.gerritserver'] = (
-         'https://chromium-review.googlesource.com')
+    self.mockGit.config.update({
+        'branch.master.gerritissue': '123',
+        'branch.master.gerritserver': (
+            'https://chromium-review.googlesource.com'),
+    })
     self.calls = [
         (('write_json', 'output.json',
           {'issue': 123,
@@ -2099,36 +2335,35 @@ class TestGitCl(unittest.TestCase):
 
   def test_GerritCommitMsgHookCheck_custom_hook(self):
     cl = self._common_GerritCommitMsgHookCheck()
-    self.calls += [((['exists',
-                      os.path.join('.git', 'hooks', 'commit-msg')], ), True),
-                   ((['FileRead',
-                      os.path.join('.git', 'hooks', 'commit-msg')], ),
+    self.calls += [((['exists', _COMMIT_MSG_HOOK], ), True),
+                   ((['FileRead', _COMMIT_MSG_HOOK], ),
                     '#!/bin/sh\necho "custom hook"')]
     cl._GerritCommitMsgHookCheck(offer_removal=True)
 
   def test_GerritCommitMsgHookCheck_not_exists(self):
     cl = self._common_GerritCommitMsgHookCheck()
     self.calls += [
-        ((['exists', os.path.join('.git', 'hooks', 'commit-msg')], ), False),
+        ((['exists', _COMMIT_MSG_HOOK], ), False),
     ]
     cl._GerritCommitMsgHookCheck(offer_removal=True)
 
   def test_GerritCommitMsgHookCheck(self):
     cl = self._common_GerritCommitMsgHookCheck()
     self.calls += [
-        ((['exists', os.path.join('.git', 'hooks', 'commit-msg')], ), True),
-        ((['FileRead', os.path.join('.git', 'hooks', 'commit-msg')], ),
+        ((['exists', _COMMIT_MSG_HOOK], ), True),
+        ((['FileRead', _COMMIT_MSG_HOOK], ),
          '...\n# From Gerrit Code Review\n...\nadd_ChangeId()\n'),
         (('ask_for_data', 'Do you want to remove it now? [Yes/No]: '), 'Yes'),
-        ((['rm_file_or_tree',
-           os.path.join('.git', 'hooks', 'commit-msg')], ), ''),
+        ((['rm_file_or_tree', _COMMIT_MSG_HOOK], ), ''),
     ]
     cl._GerritCommitMsgHookCheck(offer_removal=True)
 
   def test_GerritCmdLand(self):
-    self.mockGit.config['branch.master.gerritsquashhash'] = 'deadbeaf'
-    self.mockGit.config['branch.master.gerritserver'] = (
-        'chromium-review.googlesource.com')
+    mock.patch('sys.stdout', StringIO()).start()
+    self.mockGit.config.update({
+        'branch.master.gerritsquashhash': 'deadbeaf',
+        'branch.master.gerritserver': 'chromium-review.googlesource.com',
+    })
     self.calls += [
       ((['git', 'diff', 'deadbeaf'],), ''),  # No diff.
     ]
@@ -2154,12 +2389,18 @@ class TestGitCl(unittest.TestCase):
         'Landed as: https://git.googlesource.com/test/+/deadbeef',
         sys.stdout.getvalue())
 
-  def _mock_gerrit_changes_for_detail_cache(self):
+  def _mock_gerrit_changes_for_detail_cache(self, *details):
+    """Makes each GetChangeDetail call return the next one of |details|.
+
+    Any call after that fails, so the tests can tell cache hits from misses.
+    """
     mock.patch('git_cl.Changelist._GetGerritHost', lambda _: 'host').start()
+    details = iter(details)
+    self._swap(gerrit_util, 'GetChangeDetail',
+               lambda *_args, **_kwargs: next(details))
 
   def test_gerrit_change_detail_cache_simple(self):
-    self._mock_gerrit_changes_for_detail_cache()
-    gerrit_util.GetChangeDetail.side_effect = ['a', 'b']
+    self._mock_gerrit_changes_for_detail_cache('a', 'b')
     cl1 = git_cl.Changelist(issue=1)
     cl1._cached_remote_url = (
         True, 'https://chromium.googlesource.com/a/my/repo.git/')
@@ -2171,8 +2412,7 @@ class TestGitCl(unittest.TestCase):
     self.assertEqual(cl2._GetChangeDetail(), 'b')  # Miss.
 
   def test_gerrit_change_detail_cache_options(self):
-    self._mock_gerrit_changes_for_detail_cache()
-    gerrit_util.GetChangeDetail.side_effect = ['cab', 'ad']
+    self._mock_gerrit_changes_for_detail_cache('cab', 'ad')
     cl = git_cl.Changelist(issue=1)
     cl._cached_remote_url = (True, 'https://chromium.googlesource.com/repo/')
     self.assertEqual(cl._GetChangeDetail(options=['C', 'A', 'B']), 'cab')
@@ -2188,14 +2428,12 @@ class TestGitCl(unittest.TestCase):
     self.assertEqual(cl._GetChangeDetail(), 'cab')
 
   def test_gerrit_description_caching(self):
-    gerrit_util.GetChangeDetail.return_value = {
+    self._mock_gerrit_changes_for_detail_cache({
       'current_revision': 'rev1',
       'revisions': {
         'rev1': {'commit': {'message': 'desc1'}},
       },
-    }
-
-    self._mock_gerrit_changes_for_detail_cache()
+    })
     cl = git_cl.Changelist(issue=1)
     cl._cached_remote_url = (
         True, 'https://chromium.googlesource.com/a/my/repo.git/')
@@ -2203,6 +2441,7 @@ class TestGitCl(unittest.TestCase):
     self.assertEqual(cl.FetchDescription(), 'desc1')  # cache hit.
 
   def test_print_current_creds(self):
+    mock.patch('sys.stdout', StringIO()).start()
     class CookiesAuthenticatorMock(object):
       def __init__(self):
         self.gitcookies = {
@@ -2214,9 +2453,12 @@ class TestGitCl(unittest.TestCase):
             'github.com': ('user2', None, 'pass2'),
             'host2.googlesource.com': ('user3', None, 'pass'),
         }
-    mock.patch('git_cl.gerrit_util.CookiesAuthenticator',
-              CookiesAuthenticatorMock).start()
-    git_cl._GitCookiesChecker().print_current_creds(include_netrc=True)
+    self._swap(git_cl.gerrit_util, 'CookiesAuthenticator',
+               CookiesAuthenticatorMock)
+    # The checker reads the credentials once, and filters out the .netrc ones
+    # when asked to.
+    checker = git_cl._GitCookiesChecker()
+    checker.print_current_creds(include_netrc=True)
     self.assertEqual(list(sys.stdout.getvalue().splitlines()), [
         '                        Host\t User\t Which file',
         '============================\t=====\t===========',
@@ -2226,7 +2468,7 @@ class TestGitCl(unittest.TestCase):
     ])
     sys.stdout.seek(0)
     sys.stdout.truncate(0)
-    git_cl._GitCookiesChecker().print_current_creds(include_netrc=False)
+    checker.print_current_creds(include_netrc=False)
     self.assertEqual(list(sys.stdout.getvalue().splitlines()), [
         '                        Host\tUser\t Which file',
         '============================\t====\t===========',
@@ -2250,19 +2492,18 @@ class TestGitCl(unittest.TestCase):
     mock.patch('os.path.exists', exists_mock).start()
 
   def test_creds_check_gitcookies_not_configured(self):
+    mock.patch('sys.stdout', StringIO()).start()
     self._common_creds_check_mocks()
     mock.patch('git_cl._GitCookiesChecker.get_hosts_with_creds',
               lambda _, include_netrc=False: []).start()
     self.calls = [
         ((['git', 'config', '--path', 'http.cookiefile'], ), CERR1),
         ((['git', 'config', '--global', 'http.cookiefile'], ), CERR1),
-        (('os.path.exists', os.path.join('~', NETRC_FILENAME)), True),
+        (('os.path.exists', _NETRC_PATH), True),
         (('ask_for_data', 'Press Enter to setup .gitcookies, '
           'or Ctrl+C to abort'), ''),
-        (([
-            'git', 'config', '--global', 'http.cookiefile',
-            os.path.expanduser(os.path.join('~', '.gitcookies'))
-        ], ), ''),
+        ((['git', 'config', '--global', 'http.cookiefile',
+           _DEFAULT_GITCOOKIES], ), ''),
     ]
     self.assertEqual(0, git_cl.main(['creds-check']))
     self.assertTrue(
@@ -2273,6 +2514,7 @@ class TestGitCl(unittest.TestCase):
         sys.stdout.getvalue())
 
   def test_creds_check_gitcookies_configured_custom_broken(self):
+    mock.patch('sys.stdout', StringIO()).start()
     self._common_creds_check_mocks()
     mock.patch('git_cl._GitCookiesChecker.get_hosts_with_creds',
               lambda _, include_netrc=False: []).start()
@@ -2285,10 +2527,8 @@ class TestGitCl(unittest.TestCase):
         (('os.path.exists', custom_cookie_path), False),
         (('ask_for_data', 'Reconfigure git to use default .gitcookies? '
           'Press Enter to reconfigure, or Ctrl+C to abort'), ''),
-        (([
-            'git', 'config', '--global', 'http.cookiefile',
-            os.path.expanduser(os.path.join('~', '.gitcookies'))
-        ], ), ''),
+        ((['git', 'config', '--global', 'http.cookiefile',
+           _DEFAULT_GITCOOKIES], ), ''),
     ]
     self.assertEqual(0, git_cl.main(['creds-check']))
     self.assertIn(
@@ -2309,8 +2549,35 @@ class TestGitCl(unittest.TestCase):
     ]
     self.assertEqual(0, git_cl.main(['comment', '-i', '10', '-a', 'msg']))
 
-  @mock.patch('git_cl.Changelist.GetBranch', return_value='foo')
-  def test_git_cl_comments_fetch_gerrit(self, *_mocks):
+  # What GetCommentsSummary returns for the change in
+  # test_git_cl_comments_fetch_gerrit.
+  _FETCH_GERRIT_COMMENTS_SUMMARY = (
+      git_cl._CommentSummary(
+        message=(
+            u'PTAL\n'
+            u'\n'
+            u'codereview.settings\n'
+            u'  Base, Line 42: https://chromium-review.googlesource.com/'
+            u'c/1/2/codereview.settings#b42\n'
+            u'  I removed this because it is bad\n'),
+        date=datetime.datetime(2017, 3, 16, 20, 0, 41, 0),
+        autogenerated=False,
+        disapproval=False, approval=False, sender=u'owner@example.com'),
+      git_cl._CommentSummary(
+        message=(
+            u'Patch Set 2: Code-Review+1\n'
+            u'\n'
+            u'/COMMIT_MSG\n'
+            u'  PS2, File comment: https://chromium-review.googlesource.com/'
+            u'c/1/2//COMMIT_MSG#\n'
+            u'  Please include a bug link\n'),
+        date=datetime.datetime(2017, 3, 17, 5, 19, 37, 500000),
+        autogenerated=False,
+        disapproval=False, approval=False, sender=u'reviewer@example.com'),
+  )
+
+  def test_git_cl_comments_fetch_gerrit(self):
+    self._swap(git_cl.Changelist, 'GetBranch', lambda _: 'foo')
     self.mockGit.config['remote.origin.url'] = (
         'https://chromium.googlesource.com/infra/infra')
     gerrit_util.GetChangeDetail.return_value = {
@@ -2391,11 +2658,11 @@ class TestGitCl(unittest.TestCase):
         {
           u'date': u'2017-03-16 20:00:41.000000',
           u'message': (
-              u'PTAL\n' +
-              u'\n' +
-              u'codereview.settings\n' +
-              u'  Base, Line 42: https://chromium-review.googlesource.com/' +
-              u'c/1/2/codereview.settings#b42\n' +
+              u'PTAL\n'
+              u'\n'
+              u'codereview.settings\n'
+              u'  Base, Line 42: https://chromium-review.googlesource.com/'
+              u'c/1/2/codereview.settings#b42\n'
               u'  I removed this because it is bad\n'),
           u'autogenerated': False,
           u'approval': False,
@@ -2404,11 +2671,11 @@ class TestGitCl(unittest.TestCase):
         }, {
           u'date': u'2017-03-17 05:19:37.500000',
           u'message': (
-              u'Patch Set 2: Code-Review+1\n' +
-              u'\n' +
-              u'/COMMIT_MSG\n' +
-              u'  PS2, File comment: https://chromium-review.googlesource' +
-              u'.com/c/1/2//COMMIT_MSG#\n' +
+              u'Patch Set 2: Code-Review+1\n'
+              u'\n'
+              u'/COMMIT_MSG\n'
+              u'  PS2, File comment: https://chromium-review.googlesource'
+              u'.com/c/1/2//COMMIT_MSG#\n'
               u'  Please include a bug link\n'),
           u'autogenerated': False,
           u'approval': False,
@@ -2417,36 +2684,26 @@ class TestGitCl(unittest.TestCase):
         }
       ]), '')
     ]
-    expected_comments_summary = [
-      git_cl._CommentSummary(
-        message=(
-            u'PTAL\n' +
-            u'\n' +
-            u'codereview.settings\n' +
-            u'  Base, Line 42: https://chromium-review.googlesource.com/' +
-            u'c/1/2/codereview.settings#b42\n' +
-            u'  I removed this because it is bad\n'),
-        date=datetime.datetime(2017, 3, 16, 20, 0, 41, 0),
-        autogenerated=False,
-        disapproval=False, approval=False, sender=u'owner@example.com'),
-      git_cl._CommentSummary(
-        message=(
-            u'Patch Set 2: Code-Review+1\n' +
-            u'\n' +
-            u'/COMMIT_MSG\n' +
-            u'  PS2, File comment: https://chromium-review.googlesource.com/' +
-            u'c/1/2//COMMIT_MSG#\n' +
-            u'  Please include a bug link\n'),
-        date=datetime.datetime(2017, 3, 17, 5, 19, 37, 500000),
-        autogenerated=False,
-        disapproval=False, approval=False, sender=u'reviewer@example.com'),
-    ]
     cl = git_cl.Changelist(
         issue=1, branchref='refs/heads/foo')
-    self.assertEqual(cl.GetCommentsSummary(), expected_comments_summary)
+    self.assertEqual(
+        tuple(cl.GetCommentsSummary()), self._FETCH_GERRIT_COMMENTS_SUMMARY)
     self.assertEqual(
         0, git_cl.main(['comments', '-i', '1', '-j', 'output.json']))
 
+  # What GetCommentsSummary returns for the change in
+  # test_git_cl_comments_robot_comments.
+  _ROBOT_COMMENTS_SUMMARY = (
+      git_cl._CommentSummary(date=datetime.datetime(2017, 3, 17, 5, 30, 37),
+        message=(
+          u'(1 comment)\n\ncodereview.settings\n'
+          u'  PS2, Line 32: https://chromium-review.googlesource.com/'
+          u'c/1/2/codereview.settings#32\n'
+          u'  Linter warning message text\n'),
+        sender=u'tricium@serviceaccount.com',
+        autogenerated=True, approval=False, disapproval=False),
+  )
+
   def test_git_cl_comments_robot_comments(self):
     # git cl comments also fetches robot comments (which are considered a type
     # of autogenerated comment), and unlike other types of comments, only robot
@@ -2535,35 +2792,26 @@ class TestGitCl(unittest.TestCase):
         ],
       }),
     ]
-    expected_comments_summary = [
-       git_cl._CommentSummary(date=datetime.datetime(2017, 3, 17, 5, 30, 37),
-         message=(
-           u'(1 comment)\n\ncodereview.settings\n'
-           u'  PS2, Line 32: https://chromium-review.googlesource.com/'
-           u'c/1/2/codereview.settings#32\n'
-           u'  Linter warning message text\n'),
-         sender=u'tricium@serviceaccount.com',
-         autogenerated=True, approval=False, disapproval=False)
-    ]
     cl = git_cl.Changelist(
         issue=1, branchref='refs/heads/foo')
-    self.assertEqual(cl.GetCommentsSummary(), expected_comments_summary)
-
-  def test_get_remote_url_with_mirror(self):
-    original_os_path_isdir = os.path.isdir
+    self.assertEqual(
+        tuple(cl.GetCommentsSummary()), self._ROBOT_COMMENTS_SUMMARY)
 
-    def selective_os_path_isdir_mock(path):
-      if path == '/cache/this-dir-exists':
-        return self._mocked_call('os.path.isdir', path)
-      return original_os_path_isdir(path)
+  def _mock_isdir(self, path):
+    """Makes os.path.isdir(path) an expected call, for this path only."""
+    original_isdir = os.path.isdir
+    self._swap(os.path, 'isdir', lambda p: (
+        self._mocked_call('os.path.isdir', p) if p == path
+        else original_isdir(p)))
 
-    mock.patch('os.path.isdir', selective_os_path_isdir_mock).start()
+  def test_get_remote_url_with_mirror(self):
+    self._mock_isdir('/cache/this-dir-exists')
 
     url = 'https://chromium.googlesource.com/my/repo'
-    self.mockGit.config['remote.origin.url'] = (
-        '/cache/this-dir-exists')
-    self.mockGit.config['/cache/this-dir-exists:remote.origin.url'] = (
-        url)
+    self.mockGit.config.update({
+        'remote.origin.url': '/cache/this-dir-exists',
+        '/cache/this-dir-exists:remote.origin.url': url,
+    })
     self.calls = [
       (('os.path.isdir', '/cache/this-dir-exists'),
        True),
@@ -2573,16 +2821,9 @@ class TestGitCl(unittest.TestCase):
     self.assertEqual(cl.GetRemoteUrl(), url)  # Must be cached.
 
   def test_get_remote_url_non_existing_mirror(self):
-    original_os_path_isdir = os.path.isdir
-
-    def selective_os_path_isdir_mock(path):
-      if path == '/cache/this-dir-doesnt-exist':
-        return self._mocked_call('os.path.isdir', path)
-      return original_os_path_isdir(path)
-
-    mock.patch('os.path.isdir', selective_os_path_isdir_mock).start()
-    mock.patch('logging.error',
-              lambda *a: self._mocked_call('logging.error', *a)).start()
+    self._mock_isdir('/cache/this-dir-doesnt-exist')
+    self._swap(logging, 'error',
+               lambda *a: self._mocked_call('logging.error', *a))
 
     self.mockGit.config['remote.origin.url'] = (
         '/cache/this-dir-doesnt-exist')
@@ -2601,16 +2842,9 @@ class TestGitCl(unittest.TestCase):
     self.assertIsNone(cl.GetRemoteUrl())
 
   def test_get_remote_url_misconfigured_mirror(self):
-    original_os_path_isdir = os.path.isdir
-
-    def selective_os_path_isdir_mock(path):
-      if path == '/cache/this-dir-exists':
-        return self._mocked_call('os.path.isdir', path)
-      return original_os_path_isdir(path)
-
-    mock.patch('os.path.isdir', selective_os_path_isdir_mock).start()
-    mock.patch('logging.error',
-              lambda *a: self._mocked_call('logging.error', *a)).start()
+    self._mock_isdir('/cache/this-dir-exists')
+    self._swap(logging, 'error',
+               lambda *a: self._mocked_call('logging.error', *a))
 
     self.mockGit.config['remote.origin.url'] = (
         '/cache/this-dir-exists')
@@ -2636,8 +2870,8 @@ class TestGitCl(unittest.TestCase):
     self.assertEqual(cl._GerritChangeIdentifier(), 'my%2Frepo~123456')
 
   def test_gerrit_change_identifier_without_project(self):
-    mock.patch('logging.error',
-              lambda *a: self._mocked_call('logging.error', *a)).start()
+    self._swap(logging, 'error',
+               lambda *a: self._mocked_call('logging.error', *a))
 
     self.calls = [
       (('logging.error',
@@ -2653,8 +2887,34 @@ class TestGitCl(unittest.TestCase):
 
 
 class ChangelistTest(unittest.TestCase):
+  # Patches installed once for the whole class. setUp resets their mocks before
+  # each test.
+  _CLASS_PATCHERS = (
+      mock.patch('git_cl.PRESUBMIT_SUPPORT', 'PRESUBMIT_SUPPORT'),
+      mock.patch('git_cl.Settings.GetRoot', return_value='root'),
+  )
+
+  # The results the presubmit script reports to the RunHook tests, and the
+  # JSON file it writes them to.
+  _RUN_HOOK_RESULTS = {
+      'more_cc': ['more@example.com', 'cc@example.com'],
+      'should_continue': True,
+  }
+  _RUN_HOOK_RESULTS_JSON = json.dumps(_RUN_HOOK_RESULTS)
+
+  @classmethod
+  def setUpClass(cls):
+    super(ChangelistTest, cls).setUpClass()
+    cls._class_mocks = _enter_patchers(cls._CLASS_PATCHERS)
+
+  @classmethod
+  def tearDownClass(cls):
+    _exit_patchers(cls._CLASS_PATCHERS)
+    super(ChangelistTest, cls).tearDownClass()
+
   def setUp(self):
     super(ChangelistTest, self).setUp()
+    _reset_mocks(self._class_mocks)
     mock.patch('gclient_utils.FileRead').start()
     mock.patch('gclient_utils.FileWrite').start()
     mock.patch('gclient_utils.temporary_file', TemporaryFileMock()).start()
@@ -2664,20 +2924,30 @@ class ChangelistTest(unittest.TestCase):
     mock.patch('git_cl.Changelist.GetAuthor', return_value='author').start()
     mock.patch('git_cl.Changelist.GetIssue', return_value=123456).start()
     mock.patch('git_cl.Changelist.GetPatchset', return_value=7).start()
-    mock.patch('git_cl.PRESUBMIT_SUPPORT', 'PRESUBMIT_SUPPORT').start()
-    mock.patch('git_cl.Settings.GetRoot', return_value='root').start()
     mock.patch('git_cl.time_time').start()
     mock.patch('metrics.collector').start()
     mock.patch('subprocess2.Popen').start()
+    git_cl.settings = None
     self.addCleanup(mock.patch.stopall)
     self.temp_count = 0
 
+  def _run_hook_argv(self, *flags):
+    """Returns the command RunHook is expected to run presubmit_support with.
+
+    flags are the options expected between the upstream and the temporary
+    files, which are always the same in these tests.
+    """
+    return [
+        'vpython', 'PRESUBMIT_SUPPORT',
+        '--root', 'root',
+        '--upstream', 'upstream',
+    ] + list(flags) + [
+        '--json_output', '/tmp/fake-temp2',
+        '--description_file', '/tmp/fake-temp1',
+    ]
+
   def testRunHook(self):
-    expected_results = {
-        'more_cc': ['more@example.com', 'cc@example.com'],
-        'should_continue': True,
-    }
-    gclient_utils.FileRead.return_value = json.dumps(expected_results)
+    gclient_utils.FileRead.return_value = self._RUN_HOOK_RESULTS_JSON
     git_cl.time_time.side_effect = [100, 200]
     mockProcess = mock.Mock()
     mockProcess.wait.return_value = 0
@@ -2694,11 +2964,8 @@ class ChangelistTest(unittest.TestCase):
         all_files=True,
         resultdb=False)
 
-    self.assertEqual(expected_results, results)
-    subprocess2.Popen.assert_called_once_with([
-        'vpython', 'PRESUBMIT_SUPPORT',
-        '--root', 'root',
-        '--upstream', 'upstream',
+    self.assertEqual(self._RUN_HOOK_RESULTS, results)
+    subprocess2.Popen.assert_called_once_with(self._run_hook_argv(
         '--verbose', '--verbose',
         '--author', 'author',
         '--gerrit_url', 'https://chromium-review.googlesource.com',
@@ -2708,9 +2975,7 @@ class ChangelistTest(unittest.TestCase):
         '--may_prompt',
         '--parallel',
         '--all_files',
-        '--json_output', '/tmp/fake-temp2',
-        '--description_file', '/tmp/fake-temp1',
-    ])
+    ))
     gclient_utils.FileWrite.assert_called_once_with(
         '/tmp/fake-temp1', 'description')
     metrics.collector.add_repeated('sub_commands', {
@@ -2720,11 +2985,7 @@ class ChangelistTest(unittest.TestCase):
     })
 
   def testRunHook_FewerOptions(self):
-    expected_results = {
-        'more_cc': ['more@example.com', 'cc@example.com'],
-        'should_continue': True,
-    }
-    gclient_utils.FileRead.return_value = json.dumps(expected_results)
+    gclient_utils.FileRead.return_value = self._RUN_HOOK_RESULTS_JSON
     git_cl.time_time.side_effect = [100, 200]
     mockProcess = mock.Mock()
     mockProcess.wait.return_value = 0
@@ -2746,15 +3007,8 @@ class ChangelistTest(unittest.TestCase):
         all_files=False,
         resultdb=False)
 
-    self.assertEqual(expected_results, results)
-    subprocess2.Popen.assert_called_once_with([
-        'vpython', 'PRESUBMIT_SUPPORT',
-        '--root', 'root',
-        '--upstream', 'upstream',
-        '--upload',
-        '--json_output', '/tmp/fake-temp2',
-        '--description_file', '/tmp/fake-temp1',
-    ])
+    self.assertEqual(self._RUN_HOOK_RESULTS, results)
+    subprocess2.Popen.assert_called_once_with(self._run_hook_argv('--upload'))
     gclient_utils.FileWrite.assert_called_once_with(
         '/tmp/fake-temp1', 'description')
     metrics.collector.add_repeated('sub_commands', {
@@ -2764,11 +3018,7 @@ class ChangelistTest(unittest.TestCase):
     })
 
   def testRunHook_FewerOptionsResultDB(self):
-    expected_results = {
-      'more_cc': ['more@example.com', 'cc@example.com'],
-      'should_continue': True,
-    }
-    gclient_utils.FileRead.return_value = json.dumps(expected_results)
+    gclient_utils.FileRead.return_value = self._RUN_HOOK_RESULTS_JSON
     git_cl.time_time.side_effect = [100, 200]
     mockProcess = mock.Mock()
     mockProcess.wait.return_value = 0
@@ -2790,16 +3040,9 @@ class ChangelistTest(unittest.TestCase):
         all_files=False,
         resultdb=True)
 
-    self.assertEqual(expected_results, results)
-    subprocess2.Popen.assert_called_once_with([
-        'rdb', 'stream', '-new',
-        'vpython', 'PRESUBMIT_SUPPORT',
-        '--root', 'root',
-        '--upstream', 'upstream',
-        '--upload',
-        '--json_output', '/tmp/fake-temp2',
-        '--description_file', '/tmp/fake-temp1',
-    ])
+    self.assertEqual(self._RUN_HOOK_RESULTS, results)
+    subprocess2.Popen.assert_called_once_with(
+        ['rdb', 'stream', '-new'] + self._run_hook_argv('--upload'))
 
   @mock.patch('sys.exit', side_effect=SystemExitMock)
   def testRunHook_Failure(self, _mock):
@@ -2877,33 +3120,59 @@ class CMDTestCaseBase(unittest.TestCase):
       } for idx, status in enumerate(_STATUSES)]
   }
 
+  # Captures the output of the tests. Emptied and patched in before each of
+  # them, rather than once for the class, since test runners such as pytest
+  # swap sys.stdout between the setup and the run of a test.
+  _STDOUT = StringIO()
+
+  # Patches installed once for each test class. setUp resets their mocks before
+  # each test. Subclasses extend this with their own.
+  _CLASS_PATCHERS = (
+      mock.patch('git_cl.uuid.uuid4', return_value='uuid4'),
+      mock.patch(
+          'git_cl.Changelist.GetCodereviewServer',
+          return_value='https://chromium-review.googlesource.com'),
+      mock.patch(
+          'git_cl.Changelist._GetGerritHost',
+          return_value='chromium-review.googlesource.com'),
+      mock.patch('git_cl.Changelist.GetMostRecentPatchset', return_value=7),
+      mock.patch(
+          'git_cl.Changelist.GetRemoteUrl',
+          return_value='https://chromium.googlesource.com/depot_tools'),
+      mock.patch('auth.Authenticator', return_value=AuthenticatorMock()),
+      mock.patch('git_common.is_dirty_git_tree', return_value=False),
+  )
+
+  # Patches whose mocks record calls or get reconfigured by tests. The
+  # patchers are built once, but started for each test, so that every test
+  # gets fresh mocks.
+  _STATIC_PATCHERS = (
+      mock.patch('git_cl.Changelist.GetIssue', return_value=123456),
+      mock.patch('gerrit_util.GetChangeDetail', return_value=_CHANGE_DETAIL),
+      mock.patch('git_cl._call_buildbucket', return_value=_DEFAULT_RESPONSE),
+  )
+
+  @classmethod
+  def setUpClass(cls):
+    super(CMDTestCaseBase, cls).setUpClass()
+    cls._class_mocks = _enter_patchers(cls._CLASS_PATCHERS)
+
+  @classmethod
+  def tearDownClass(cls):
+    _exit_patchers(cls._CLASS_PATCHERS)
+    super(CMDTestCaseBase, cls).tearDownClass()
+
   def setUp(self):
     super(CMDTestCaseBase, self).setUp()
-    mock.patch('git_cl.sys.stdout', StringIO()).start()
-    mock.patch('git_cl.uuid.uuid4', return_value='uuid4').start()
-    mock.patch('git_cl.Changelist.GetIssue', return_value=123456).start()
-    mock.patch(
-        'git_cl.Changelist.GetCodereviewServer',
-        return_value='https://chromium-review.googlesource.com').start()
-    mock.patch(
-        'git_cl.Changelist._GetGerritHost',
-        return_value='chromium-review.googlesource.com').start()
-    mock.patch(
-        'git_cl.Changelist.GetMostRecentPatchset',
-        return_value=7).start()
-    mock.patch(
-        'git_cl.Changelist.GetRemoteUrl',
-        return_value='https://chromium.googlesource.com/depot_tools').start()
-    mock.patch(
-        'auth.Authenticator',
-        return_value=AuthenticatorMock()).start()
-    mock.patch(
-        'gerrit_util.GetChangeDetail',
-        return_value=self._CHANGE_DETAIL).start()
-    mock.patch(
-        'git_cl._call_buildbucket',
-        return_value = self._DEFAULT_RESPONSE).start()
-    mock.patch('git_common.is_dirty_git_tree', return_value=False).start()
+    self._STDOUT.seek(0)
+    self._STDOUT.truncate()
+    mock.patch('git_cl.sys.stdout', self._STDOUT).start()
+    _reset_mocks(self._class_mocks)
+    for patcher in self._STATIC_PATCHERS:
+      patcher.start()
+    # Every test class resets settings so that the tests don't depend on the
+    # order, or the process, in which they are run.
+    git_cl.settings = None
     self.addCleanup(mock.patch.stopall)
 
 
@@ -3237,8 +3506,8 @@ class CMDTryTestCase(CMDTestCaseBase):
     mockCallBuildbucket.assert_called_with(
         mock.ANY, 'cr-buildbucket.appspot.com', 'Batch', expected_request)
 
-  @mock.patch('sys.stderr', StringIO())
   def testScheduleOnBuildbucket_WrongBucket(self):
+    mock.patch('sys.stderr', StringIO()).start()
     with self.assertRaises(SystemExit):
       git_cl.main([
           'try', '-B', 'not-a-bucket', '-b', 'win',
@@ -3300,57 +3569,40 @@ class CMDTryTestCase(CMDTestCaseBase):
         mock.ANY, 'cr-buildbucket.appspot.com', 'Batch', expected_request)
 
   def test_parse_bucket(self):
-    test_cases = [
-        {
-            'bucket': 'chromium/try',
-            'result': ('chromium', 'try'),
-        },
-        {
-            'bucket': 'luci.chromium.try',
-            'result': ('chromium', 'try'),
-            'has_warning': True,
-        },
-        {
-            'bucket': 'skia.primary',
-            'result': ('skia', 'skia.primary'),
-            'has_warning': True,
-        },
-        {
-            'bucket': 'not-a-bucket',
-            'result': (None, None),
-        },
-    ]
-
-    for test_case in test_cases:
-      git_cl.sys.stdout.truncate(0)
-      self.assertEqual(
-          test_case['result'], git_cl._parse_bucket(test_case['bucket']))
-      if test_case.get('has_warning'):
+    # (bucket, expected result, whether a warning is expected).
+    cases = (
+      ('chromium/try', ('chromium', 'try'), False),
+      ('luci.chromium.try', ('chromium', 'try'), True),
+      ('skia.primary', ('skia', 'skia.primary'), True),
+      ('not-a-bucket', (None, None), False),
+    )
+
+    for bucket, result, has_warning in cases:
+      git_cl.sys.stdout.seek(0)
+      git_cl.sys.stdout.truncate()
+      self.assertEqual(result, git_cl._parse_bucket(bucket))
+      if has_warning:
         expected_warning = 'WARNING Please use %s/%s to specify the bucket' % (
-            test_case['result'])
+            result)
         self.assertIn(expected_warning, git_cl.sys.stdout.getvalue())
 
 
 class CMDUploadTestCase(CMDTestCaseBase):
-
-  def setUp(self):
-    super(CMDUploadTestCase, self).setUp()
-    mock.patch('git_cl._fetch_tryjobs').start()
-    mock.patch('git_cl._trigger_tryjobs', return_value={}).start()
-    mock.patch('git_cl.Changelist.CMDUpload', return_value=0).start()
-    mock.patch('git_cl.Settings.GetRoot', return_value='').start()
-    mock.patch(
-        'git_cl.Settings.GetSquashGerritUploads',
-        return_value=True).start()
-    self.addCleanup(mock.patch.stopall)
+  _CLASS_PATCHERS = CMDTestCaseBase._CLASS_PATCHERS + (
+      mock.patch('git_cl.Changelist.CMDUpload', return_value=0),
+      mock.patch('git_cl.Settings.GetRoot', return_value=''),
+      mock.patch('git_cl.Settings.GetSquashGerritUploads', return_value=True),
+  )
+  _STATIC_PATCHERS = CMDTestCaseBase._STATIC_PATCHERS + (
+      mock.patch('git_cl._fetch_tryjobs'),
+      mock.patch('git_cl._trigger_tryjobs', return_value={}),
+  )
 
   def testWarmUpChangeDetailCache(self):
     self.assertEqual(0, git_cl.main(['upload']))
     gerrit_util.GetChangeDetail.assert_called_once_with(
         'chromium-review.googlesource.com', 'depot_tools~123456',
-        frozenset([
-            'LABELS', 'CURRENT_REVISION', 'DETAILED_ACCOUNTS',
-            'CURRENT_COMMIT']))
+        git_cl._CHANGE_DETAIL_OPTIONS)
 
   def testUploadRetryFailed(self):
     # This test mocks out the actual upload part, and just asserts that after
@@ -3361,17 +3613,7 @@ class CMDUploadTestCase(CMDTestCaseBase):
         # Latest patchset: No builds.
         [],
         # Patchset before latest: Some builds.
-        [{
-            'id': str(100 + idx),
-            'builder': {
-                'project': 'chromium',
-                'bucket': 'try',
-                'builder': 'bot_' + status.lower(),
-            },
-            'createTime': '2019-10-09T08:00:0%d.854286Z' % (idx % 10),
-            'tags': [],
-            'status': status,
-        } for idx, status in enumerate(self._STATUSES)],
+        self._DEFAULT_RESPONSE['builds'],
     ]
 
     self.assertEqual(0, git_cl.main(['upload', '--retry-failed']))
@@ -3491,28 +3733,44 @@ class MakeRequestsHelperTestCase(unittest.TestCase):
 
 
 class CMDFormatTestCase(unittest.TestCase):
+  # Patchers built once, but started for each test, so that every test gets
+  # fresh mocks.
+  _STATIC_PATCHERS = (
+      mock.patch('git_cl.RunCommand'),
+      mock.patch('clang_format.FindClangFormatToolInChromiumTree'),
+      mock.patch('clang_format.FindClangFormatScriptInChromiumTree'),
+      mock.patch('git_cl.settings'),
+  )
+
+  @classmethod
+  def setUpClass(cls):
+    super(CMDFormatTestCase, cls).setUpClass()
+    # Shared by all the tests, which remove the files they create.
+    cls._top_dir = tempfile.mkdtemp()
+
+  @classmethod
+  def tearDownClass(cls):
+    shutil.rmtree(cls._top_dir)
+    super(CMDFormatTestCase, cls).tearDownClass()
 
   def setUp(self):
     super(CMDFormatTestCase, self).setUp()
-    mock.patch('git_cl.RunCommand').start()
-    mock.patch('clang_format.FindClangFormatToolInChromiumTree').start()
-    mock.patch('clang_format.FindClangFormatScriptInChromiumTree').start()
-    mock.patch('git_cl.settings').start()
-    self._top_dir = tempfile.mkdtemp()
+    for patcher in self._STATIC_PATCHERS:
+      patcher.start()
     self.addCleanup(mock.patch.stopall)
 
-  def tearDown(self):
-    shutil.rmtree(self._top_dir)
-    super(CMDFormatTestCase, self).tearDown()
-
   def _make_temp_file(self, fname, contents):
-    with open(os.path.join(self._top_dir, fname), 'w') as tf:
+    path = os.path.join(self._top_dir, fname)
+    with open(path, 'w') as tf:
       tf.write('\n'.join(contents))
+    self.addCleanup(os.remove, path)
 
-  def _make_yapfignore(self, contents):
-    self._make_temp_file('.yapfignore', contents)
+  def _check_yapf_filtering(self, yapfignore, files, expected):
+    self.assertEqual(expected, git_cl._FilterYapfIgnoredFiles(
+        files, git_cl._ParseYapfIgnorePatterns(yapfignore)))
 
-  def _check_yapf_filtering(self, files, expected):
+  def _check_yapf_filtering_in_dir(self, files, expected):
+    """Like _check_yapf_filtering, with the .yapfignore in the temp dir."""
     self.assertEqual(expected, git_cl._FilterYapfIgnoredFiles(
         files, git_cl._GetYapfIgnorePatterns(self._top_dir)))
 
@@ -3560,7 +3818,7 @@ class CMDFormatTestCase(unittest.TestCase):
     self.assertEqual(0, return_value)
 
   def testYapfignoreExplicit(self):
-    self._make_yapfignore(['foo/bar.py', 'foo/bar/baz.py'])
+    yapfignore = ['foo/bar.py', 'foo/bar/baz.py']
     files = [
       'bar.py',
       'foo/bar.py',
@@ -3573,10 +3831,10 @@ class CMDFormatTestCase(unittest.TestCase):
       'foo/baz.py',
       'foo/bar/foobar.py',
     ]
-    self._check_yapf_filtering(files, expected)
+    self._check_yapf_filtering(yapfignore, files, expected)
 
   def testYapfignoreSingleWildcards(self):
-    self._make_yapfignore(['*bar.py', 'foo*', 'baz*.py'])
+    yapfignore = ['*bar.py', 'foo*', 'baz*.py']
     files = [
       'bar.py',       # Matched by *bar.py.
       'bar.txt',
@@ -3594,10 +3852,10 @@ class CMDFormatTestCase(unittest.TestCase):
       'bazbar.txt',
       'baz/foo.txt',
     ]
-    self._check_yapf_filtering(files, expected)
+    self._check_yapf_filtering(yapfignore, files, expected)
 
   def testYapfignoreMultiplewildcards(self):
-    self._make_yapfignore(['*bar*', '*foo*baz.txt'])
+    yapfignore = ['*bar*', '*foo*baz.txt']
     files = [
       'bar.py',       # Matched by *bar*.
       'bar.txt',      # Matched by *bar*.
@@ -3609,10 +3867,10 @@ class CMDFormatTestCase(unittest.TestCase):
     expected = [
       'foobaz.py',
     ]
-    self._check_yapf_filtering(files, expected)
+    self._check_yapf_filtering(yapfignore, files, expected)
 
   def testYapfignoreComments(self):
-    self._make_yapfignore(['test.py', '#test2.py'])
+    yapfignore = ['test.py', '#test2.py']
     files = [
       'test.py',
       'test2.py',
@@ -3620,10 +3878,10 @@ class CMDFormatTestCase(unittest.TestCase):
     expected = [
       'test2.py',
     ]
-    self._check_yapf_filtering(files, expected)
+    self._check_yapf_filtering(yapfignore, files, expected)
 
   def testYapfignoreBlankLines(self):
-    self._make_yapfignore(['test.py', '', '', 'test2.py'])
+    yapfignore = ['test.py', '', '', 'test2.py']
     files = [
       'test.py',
       'test2.py',
@@ -3632,10 +3890,10 @@ class CMDFormatTestCase(unittest.TestCase):
     expected = [
       'test3.py',
     ]
-    self._check_yapf_filtering(files, expected)
+    self._check_yapf_filtering(yapfignore, files, expected)
 
   def testYapfignoreWhitespace(self):
-    self._make_yapfignore([' test.py '])
+    yapfignore = [' test.py ']
     files = [
       'test.py',
       'test2.py',
@@ -3643,20 +3901,65 @@ class CMDFormatTestCase(unittest.TestCase):
     expected = [
       'test2.py',
     ]
-    self._check_yapf_filtering(files, expected)
+    self._check_yapf_filtering(yapfignore, files, expected)
 
-  def testYapfignoreNoFiles(self):
-    self._make_yapfignore(['test.py'])
-    self._check_yapf_filtering([], [])
+  def testYapfignoreNoPatterns(self):
+    self._check_yapf_filtering([], ['test.py'], ['test.py'])
 
-  def testYapfignoreMissingYapfignore(self):
+  def testYapfignoreRegexCharacters(self):
+    # The patterns are matched with a single regex, so check that regex
+    # characters stay literal and that each pattern is anchored on its own.
+    yapfignore = ['a.py', 'b[12].py', 'c+d.py', 'e(f).py', 'foo', '*.txt']
     files = [
-      'test.py',
+      'a.py',      # Matched by a.py.
+      'axpy',
+      'a.pyc',
+      'xa.py',
+      'b1.py',     # Matched by b[12].py.
+      'b3.py',
+      'b[12].py',
+      'c+d.py',    # Matched by c+d.py.
+      'ccd.py',
+      'cd.py',
+      'e(f).py',   # Matched by e(f).py.
+      'ef.py',
+      'foo',       # Matched by foo.
+      'foo.py',
+      'xfoo',
+      'a.py.txt',  # Matched by *.txt.
+      'txt',
     ]
     expected = [
-      'test.py',
+      'axpy',
+      'a.pyc',
+      'xa.py',
+      'b3.py',
+      'b[12].py',
+      'ccd.py',
+      'cd.py',
+      'ef.py',
+      'foo.py',
+      'xfoo',
+      'txt',
     ]
-    self._check_yapf_filtering(files, expected)
+    self._check_yapf_filtering(yapfignore, files, expected)
+
+  def testYapfignoreNoFiles(self):
+    yapfignore = ['test.py']
+    self._check_yapf_filtering(yapfignore, [], [])
+
+  def testGetYapfIgnorePatterns(self):
+    self._make_temp_file('.yapfignore', ['# Comment.', ' test.py ', 'foo/*'])
+    self.assertEqual(
+        {'test.py', 'foo/*'}, git_cl._GetYapfIgnorePatterns(self._top_dir))
+
+  def testYapfignoreMissingYapfignore(self):
+    self.assertEqual(set(), git_cl._GetYapfIgnorePatterns(self._top_dir))
+    self._check_yapf_filtering_in_dir(['test.py'], ['test.py'])
+
+  def testYapfignoreOnlyComments(self):
+    self._make_temp_file('.yapfignore', ['# test.py', '', '#'])
+    self._check_yapf_filtering_in_dir(['test.py'], ['test.py'])
 
 
 if __name__ == '__main__':